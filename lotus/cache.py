@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+
+# open caches, keyed by process and path, as connections can't be shared with forked processes
+_SHARED_CACHES = {}
+
+
+class MediaCache:
+    """Cache of media file hashes and MIME types
+
+    Entries are keyed by the device, inode, size and modification time of the file, so a file
+    that has been replaced or modified since it was cached is not matched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        # the cache can be written to by several worker processes at once, and by several threads
+        # in each process
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS media (device INTEGER, "
+                                "inode INTEGER, size INTEGER, mtime INTEGER, path TEXT, "
+                                "file_hash TEXT, mime_type TEXT, "
+                                "PRIMARY KEY (device, inode, size, mtime))")
+        self.connection.commit()
+
+    @classmethod
+    def shared(cls, path):
+        """Get cache at path, opening it if this process hasn't already"""
+        key = (os.getpid(), path)
+
+        if key not in _SHARED_CACHES:
+            _SHARED_CACHES[key] = cls(path)
+
+        return _SHARED_CACHES[key]
+
+    @staticmethod
+    def _key(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, stat):
+        """Get hash and MIME type of file with the specified stat result, or None if not cached"""
+        with self.lock:
+            return self.connection.execute("SELECT file_hash, mime_type FROM media WHERE "
+                                           "device = ? AND inode = ? AND size = ? AND mtime = ?",
+                                           self._key(stat)).fetchone()
+
+    def put(self, stat, path, file_hash, mime_type):
+        """Cache hash and MIME type of file at path with the specified stat result"""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    self._key(stat) + (path, file_hash, mime_type))
+            self.connection.commit()
+
+    def evict(self):
+        """Remove entries for files that no longer exist or have changed, returning the number removed"""
+        stale = []
+
+        for row in self.connection.execute("SELECT device, inode, size, mtime, path FROM media"):
+            key, path = row[:4], row[4]
+
+            try:
+                current_key = self._key(os.stat(path))
+            except FileNotFoundError:
+                current_key = None
+
+            if current_key != key:
+                stale.append(key)
+
+        self.connection.executemany("DELETE FROM media WHERE device = ? AND inode = ? "
+                                    "AND size = ? AND mtime = ?", stale)
+        self.connection.commit()
+
+        return len(stale)
+
+    def close(self):
+        self.connection.close()
+        _SHARED_CACHES.pop((os.getpid(), self.path), None)
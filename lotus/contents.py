@@ -0,0 +1,179 @@
+import logging
+import collections
+from lxml import etree
+
+from .decode import ENCODINGS, IncrementalMarkupDecoder, describe_removed
+from .stats import current as current_stats
+
+LOGGER = logging.getLogger("lotus")
+
+# title prefix of links to responses
+RESPONSE_PREFIX = "---------- Respond:"
+
+# number of elements after the start of a page link at which its page number is found
+PAGE_NUMBER_OFFSET = 7
+
+# size of chunks to feed to the parser
+CHUNK_SIZE = 1048576
+
+ContentsLink = collections.namedtuple("ContentsLink", ("title", "number", "href", "is_response"))
+
+
+class _PendingLink:
+    """Page link whose title or page number has not yet been parsed"""
+    def __init__(self, href, depth):
+        self.href = href
+        # depth of the link's element, used to find its end
+        self.depth = depth
+        self.title_parts = []
+        self.title = None
+        # number of elements seen since the start of the link
+        self.offset = 0
+        self.number = None
+        # the page number is in the next string
+        self.number_in_next_string = False
+
+    @property
+    def is_response(self):
+        return self.title.startswith(RESPONSE_PREFIX)
+
+    @property
+    def complete(self):
+        return self.title is not None and (self.is_response or self.number is not None)
+
+
+class ContentsScanner:
+    """lxml parser target that extracts page links from a contents page as it is parsed
+
+    No document tree is built. A link's page number is the string PAGE_NUMBER_OFFSET elements (start
+    tags, strings and comments, in document order) after the start of the link, which is where
+    following BeautifulSoup's `next` attribute from the link leads.
+    """
+
+    def __init__(self):
+        # completed links, in document order
+        self.links = []
+        self._pending = []
+        self._depth = 0
+        self._text = []
+
+    def start(self, tag, attrib):
+        self._flush_text()
+        self._advance()
+
+        self._depth += 1
+
+        if tag == "a" and attrib.get("target") == "NotesView" and "href" in attrib:
+            self._pending.append(_PendingLink(attrib["href"], self._depth))
+
+    def end(self, tag):
+        self._flush_text()
+
+        for link in self._pending:
+            if link.title is None and link.depth == self._depth:
+                link.title = "".join(link.title_parts)
+
+        self._depth -= 1
+        self._emit()
+
+    def data(self, data):
+        # strings can be delivered in several parts
+        self._text.append(data)
+
+    def comment(self, text):
+        self._flush_text()
+        # comments are strings to BeautifulSoup
+        self._advance(text)
+
+    def close(self):
+        self._flush_text()
+        self._emit()
+
+        if self._pending:
+            raise ValueError("couldn't find page number for link to %s" % self._pending[0].href)
+
+        return self.links
+
+    def _flush_text(self):
+        if not self._text:
+            return
+
+        text = "".join(self._text)
+        self._text = []
+
+        for link in self._pending:
+            if link.title is None:
+                # string is part of the link's title
+                link.title_parts.append(text)
+
+            if link.number_in_next_string:
+                link.number = text
+                link.number_in_next_string = False
+
+        self._advance(text)
+
+    def _advance(self, text=None):
+        """Count element for pending links, with its text if the element is a string or comment"""
+        for link in self._pending:
+            if link.number is not None or link.number_in_next_string:
+                continue
+
+            link.offset += 1
+
+            if link.offset == PAGE_NUMBER_OFFSET:
+                if text is not None:
+                    link.number = text
+                else:
+                    # page number is the string contained in this element
+                    link.number_in_next_string = True
+
+    def _emit(self):
+        while self._pending and self._pending[0].complete:
+            link = self._pending.pop(0)
+
+            if link.is_response:
+                number = None
+            else:
+                number = int(link.number)
+
+            self.links.append(ContentsLink(link.title, number, link.href, link.is_response))
+
+
+def _scan_contents(obj, encoding):
+    """Get links in the contents page read from obj, decoded with encoding as it is read
+
+    Returns the links and a counter of the characters removed.
+    """
+    parser = etree.HTMLParser(target=ContentsScanner())
+    decoder = IncrementalMarkupDecoder(encoding)
+
+    while True:
+        data = obj.read(CHUNK_SIZE)
+        current_stats().add_bytes("contents_read", len(data))
+
+        parser.feed(decoder.decode(data, final=not data))
+
+        if not data:
+            break
+
+    return parser.close(), decoder.removed
+
+def scan_contents_page(path):
+    """Get links to pages and responses in the contents page at path, in document order
+
+    The page is read, decoded and parsed in chunks, so memory use doesn't grow with its size.
+    """
+    with open(path, "rb") as obj:
+        try:
+            links, removed = _scan_contents(obj, ENCODINGS[0])
+        except UnicodeDecodeError:
+            # not UTF-8, so start again with windows-1252, which every byte sequence can be
+            # decoded as
+            obj.seek(0)
+            links, removed = _scan_contents(obj, ENCODINGS[1])
+
+    if removed:
+        LOGGER.warning("removed characters not allowed in XML from %s: %s", path,
+                       describe_removed(removed))
+
+    return links
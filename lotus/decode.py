@@ -0,0 +1,118 @@
+import re
+import codecs
+import collections
+from itertools import chain
+
+# encodings tried in turn to decode scraped files
+ENCODINGS = ("utf-8", "windows-1252")
+
+# code points not allowed in XML documents: control characters other than tab, newline and carriage
+# return, surrogates and the non-characters U+FFFE and U+FFFF
+XML_ILLEGAL_CODE_POINTS = tuple(chain(range(0x00, 0x09), (0x0B, 0x0C), range(0x0E, 0x20),
+                                      range(0xD800, 0xE000), (0xFFFE, 0xFFFF)))
+
+# control characters not allowed in XML, as bytes, other than NUL, which is a sign of binary data
+CONTROL_BYTES = bytes(range(0x01, 0x09)) + b"\x0b\x0c" + bytes(range(0x0e, 0x20))
+
+_XML_ILLEGAL_TABLE = dict.fromkeys(XML_ILLEGAL_CODE_POINTS)
+_XML_ILLEGAL_PATTERN = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+DecodedText = collections.namedtuple("DecodedText", ("text", "encoding", "removed"))
+
+
+def _undefined_windows_1252(error):
+    # windows-1252 leaves a few bytes undefined; decode them as the C1 control characters with the
+    # same values, as browsers do
+    return "".join(chr(byte) for byte in error.object[error.start:error.end]), error.end
+
+codecs.register_error("lotus-windows-1252", _undefined_windows_1252)
+
+
+def decode_bytes(data):
+    """Decode bytes read from a scraped file, returning the text and the encoding used
+
+    The data is decoded as UTF-8 if it is valid UTF-8, and otherwise as windows-1252, which every
+    byte sequence can be decoded as. Newlines are translated as if the file was read in text mode.
+    """
+    try:
+        text = data.decode(ENCODINGS[0])
+        encoding = ENCODINGS[0]
+    except UnicodeDecodeError:
+        text = data.decode(ENCODINGS[1], errors="lotus-windows-1252")
+        encoding = ENCODINGS[1]
+
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    return text, encoding
+
+def strip_control_bytes(data):
+    """Remove control characters not allowed in XML, other than NUL, from bytes"""
+    return data.translate(None, CONTROL_BYTES)
+
+def strip_xml_illegal(text):
+    """Remove code points not allowed in XML from text
+
+    Returns the text and a counter of the characters removed.
+    """
+    removed = collections.Counter()
+
+    if _XML_ILLEGAL_PATTERN.search(text) is None:
+        # nothing to remove
+        return text, removed
+
+    removed.update(_XML_ILLEGAL_PATTERN.findall(text))
+
+    return text.translate(_XML_ILLEGAL_TABLE), removed
+
+def decode_markup(data):
+    """Decode bytes read from a scraped file into text that can be stored in XML"""
+    text, encoding = decode_bytes(data)
+    text, removed = strip_xml_illegal(text)
+
+    return DecodedText(text, encoding, removed)
+
+class IncrementalMarkupDecoder:
+    """Decodes a scraped file read in chunks into text that can be stored in XML
+
+    Each chunk is decoded as decode_markup would decode the whole file with the specified encoding.
+    Invalid UTF-8 raises UnicodeDecodeError, after which the file can be decoded again as
+    windows-1252. The characters removed so far are counted in removed.
+    """
+
+    def __init__(self, encoding):
+        if encoding == ENCODINGS[1]:
+            errors = "lotus-windows-1252"
+        else:
+            errors = "strict"
+
+        self.encoding = encoding
+        self.removed = collections.Counter()
+
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+        # carriage return at the end of the last chunk, which may start a "\r\n"
+        self._carriage_return = False
+
+    def decode(self, data, final=False):
+        text = self._decoder.decode(data, final)
+
+        if self._carriage_return:
+            text = "\r" + text
+            self._carriage_return = False
+
+        if text.endswith("\r") and not final:
+            text = text[:-1]
+            self._carriage_return = True
+
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        text, removed = strip_xml_illegal(text)
+        self.removed.update(removed)
+
+        return text
+
+def describe_removed(removed):
+    """Describe characters removed by strip_xml_illegal for logging"""
+    return ", ".join("%i U+%04X" % (count, ord(character))
+                     for character, count in sorted(removed.items()))
@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+
+
+class ExportState:
+    """What has been written to WordPress import files, so later ones only have what changed
+
+    Keeps a digest of each post's item as it was last written, with the media, coauthor terms and
+    categories written and the post and author ids given. If a path is specified, the state is
+    loaded from and saved there; otherwise nothing has been exported before and nothing is kept.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+        # page hashes -> digests of their post items
+        self.posts = {}
+        # kinds and archive paths of media
+        self.media = set()
+        # author display names -> author ids, and category names
+        self.authors = {}
+        self.categories = set()
+        # page hashes and media keys -> post ids, as saved by PostIdAllocator
+        self.post_ids = {}
+        # highest comment and term ids given
+        self.last_comment_id = 0
+        self.last_term_id = 0
+
+        if self.path is not None and os.path.isfile(self.path):
+            with open(self.path, "r") as obj:
+                state = json.load(obj)
+
+            self.posts = state["posts"]
+            self.media = set(tuple(media) for media in state["media"])
+            self.authors = state["authors"]
+            self.categories = set(state["categories"])
+            self.post_ids = state["post_ids"]
+            self.last_comment_id = state["last_comment_id"]
+            self.last_term_id = state["last_term_id"]
+
+    @staticmethod
+    def digest(parts):
+        """Digest of a serialised post item, split where its comment ids go"""
+        digest = hashlib.sha1()
+
+        for part in parts:
+            digest.update(part)
+            # so moving text between parts changes the digest
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def changed(self, unique_hash, digest):
+        """Check if the post with unique_hash is new, or was written with a different digest"""
+        return self.posts.get(unique_hash) != digest
+
+    def save(self):
+        if self.path is None:
+            return
+
+        state = {"posts": self.posts,
+                 "media": sorted(self.media),
+                 "authors": self.authors,
+                 "categories": sorted(self.categories),
+                 "post_ids": self.post_ids,
+                 "last_comment_id": self.last_comment_id,
+                 "last_term_id": self.last_term_id}
+
+        # replaced atomically, so the state is never lost if writing is interrupted
+        temporary_path = "%s.%i.tmp" % (self.path, os.getpid())
+
+        with open(temporary_path, "w") as obj:
+            json.dump(state, obj, indent=0, sort_keys=True)
+
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,144 @@
+import os
+import json
+import fnmatch
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+IndexedFile = collections.namedtuple("IndexedFile", ("path", "size", "mtime", "kind"))
+
+
+def scraped_file_kind(filename):
+    """Kind of file in a scraped Lotus Notes tree"""
+    if "OpenView" in filename:
+        return "contents"
+    elif "OpenDocument" in filename[1:]:
+        return "document"
+
+    return "media"
+
+def archive_file_kind(filename):
+    """Kind of file in an archive pages directory"""
+    if filename.endswith(".xml"):
+        return "page"
+
+    return "media"
+
+
+class FileIndex:
+    """Index of the files in a directory tree
+
+    Directories are listed with os.scandir, several at a time. If the index is saved, directories
+    whose modification times are unchanged on later runs are not listed again, so a tree in which
+    nothing has been added, removed or renamed is indexed with one stat call per directory. Note
+    that sizes and modification times of files are those recorded when their directory was last
+    listed.
+    """
+
+    def __init__(self, root_dir, index_path=None, recursive=True, classify=None, jobs=None):
+        if classify is None:
+            classify = scraped_file_kind
+
+        self.root_dir = root_dir
+        self.index_path = index_path
+        self.recursive = recursive
+        self.classify = classify
+        # number of directories to list at once (None for ThreadPoolExecutor default)
+        self.jobs = jobs
+
+        # directory listings, keyed by path relative to the root
+        self.directories = {}
+        # directory listings from previous run
+        self._previous_directories = {}
+
+        self.load()
+
+    def load(self):
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return
+
+        with open(self.index_path, "r") as obj:
+            data = json.load(obj)
+
+        if data["root"] != os.path.abspath(self.root_dir) or data["recursive"] != self.recursive:
+            # index of something else
+            return
+
+        self._previous_directories = data["directories"]
+
+    def save(self):
+        if self.index_path is None:
+            return
+
+        data = {"root": os.path.abspath(self.root_dir), "recursive": self.recursive,
+                "directories": self.directories}
+
+        with open(self.index_path, "w") as obj:
+            json.dump(data, obj)
+
+    def _list_directory(self, rel_dir):
+        path = os.path.join(self.root_dir, rel_dir)
+        mtime = os.stat(path).st_mtime_ns
+
+        previous = self._previous_directories.get(rel_dir)
+
+        if previous is not None and previous["mtime"] == mtime:
+            # no files added, removed or renamed since previous run
+            return previous
+
+        files = {}
+        directories = []
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns, self.classify(entry.name)]
+
+        return {"mtime": mtime, "files": files, "directories": sorted(directories)}
+
+    def update(self):
+        """Index files in tree"""
+        self.directories = {}
+
+        # list directories a level at a time
+        level = [""]
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while level:
+                next_level = []
+
+                for rel_dir, listing in zip(level, executor.map(self._list_directory, level)):
+                    self.directories[rel_dir] = listing
+
+                    if self.recursive:
+                        next_level.extend(os.path.join(rel_dir, name)
+                                          for name in listing["directories"])
+
+                level = next_level
+
+    def files(self, kind=None):
+        """Indexed files, optionally only of the specified kind, sorted by path"""
+        files = []
+
+        for rel_dir, listing in self.directories.items():
+            for filename, (size, mtime, file_kind) in listing["files"].items():
+                if kind is not None and file_kind != kind:
+                    continue
+
+                files.append(IndexedFile(os.path.join(rel_dir, filename), size, mtime, file_kind))
+
+        return sorted(files)
+
+    def paths(self, kind=None):
+        """Paths relative to the root of indexed files, optionally only of the specified kind"""
+        return [indexed_file.path for indexed_file in self.files(kind)]
+
+    def match(self, pattern):
+        """Paths relative to the root of indexed files matching glob pattern"""
+        # like glob, wildcards don't match directory separators
+        depth = pattern.count(os.sep)
+
+        return [path for path in self.paths()
+                if path.count(os.sep) == depth and fnmatch.fnmatchcase(path, pattern)]
@@ -0,0 +1,119 @@
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOGGER = logging.getLogger("lotus")
+
+FORMAT = "%(name)-25s - %(levelname)-8s - %(message)s"
+
+# handler on the lotus logger that queues records, and the listener that writes them from a thread
+_queue_handler = None
+_listener = None
+# handlers writing directly from the lotus logger, in forked worker processes
+_direct_handlers = []
+
+
+class QuietFilter(logging.Filter):
+    """Passes only progress lines and errors"""
+
+    def filter(self, record):
+        return record.levelno >= logging.ERROR or getattr(record, "progress", False)
+
+
+def setup_logging(debug_log_file=None, quiet=None):
+    """Log INFO or higher to stdout, and DEBUG or higher to debug_log_file if specified
+
+    Records are queued and written by a background thread, so logging doesn't wait for the
+    terminal or disk. If neither debug_log_file nor quiet is specified and logging is already set
+    up, e.g. by the builder a writer is used with, it is left as it is. Otherwise handlers installed
+    by a previous call are replaced, so creating several builders and writers in one process
+    doesn't duplicate lines. In quiet mode, only progress lines and errors are written to stdout.
+
+    Returns the lotus logger.
+    """
+    global _queue_handler, _listener
+
+    if debug_log_file is None and quiet is None and (_listener is not None or _direct_handlers):
+        return LOGGER
+
+    formatter = logging.Formatter(FORMAT)
+
+    # log INFO or higher to stdout
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.INFO)
+
+    if quiet:
+        stream_handler.addFilter(QuietFilter())
+
+    handlers = [stream_handler]
+
+    if debug_log_file is not None:
+        # delete existing log file
+        if os.path.exists(debug_log_file):
+            os.remove(debug_log_file)
+
+        # log DEBUG or higher to file
+        file_handler = logging.FileHandler(debug_log_file)
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.DEBUG)
+        handlers.append(file_handler)
+
+    stop_logging()
+
+    _queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers,
+                                               respect_handler_level=True)
+
+    # don't create records for messages that no handler would write
+    if debug_log_file is not None:
+        LOGGER.setLevel(logging.DEBUG)
+    else:
+        LOGGER.setLevel(logging.INFO)
+
+    LOGGER.addHandler(_queue_handler)
+    _listener.start()
+
+    return LOGGER
+
+def stop_logging():
+    """Write queued records and remove the handlers installed by setup_logging"""
+    global _queue_handler, _listener
+
+    if _listener is not None:
+        # writes remaining records before returning
+        _listener.stop()
+
+        for handler in _listener.handlers:
+            handler.close()
+
+        LOGGER.removeHandler(_queue_handler)
+
+        _queue_handler = None
+        _listener = None
+
+    for handler in _direct_handlers:
+        LOGGER.removeHandler(handler)
+
+    _direct_handlers.clear()
+
+def _log_directly():
+    """Write records directly in forked processes, which don't have the listener's thread"""
+    global _queue_handler, _listener
+
+    if _listener is None:
+        return
+
+    LOGGER.removeHandler(_queue_handler)
+
+    for handler in _listener.handlers:
+        LOGGER.addHandler(handler)
+        _direct_handlers.append(handler)
+
+    _queue_handler = None
+    _listener = None
+
+os.register_at_fork(after_in_child=_log_directly)
+atexit.register(stop_logging)
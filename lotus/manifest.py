@@ -0,0 +1,109 @@
+import os
+import json
+
+from .tools import file_md5
+
+
+class SourceManifest:
+    """Record of scraped source files and the archive files produced from them
+
+    A source is considered unchanged since the previous run if its size and modification time are
+    the same, or failing that, if its content digest is the same.
+    """
+
+    def __init__(self, path, settings=None):
+        if settings is None:
+            settings = {}
+
+        self.path = path
+        self.settings = settings
+
+        # sources and documents recorded on the previous run
+        self.previous_sources = {}
+        self.previous_documents = {}
+
+        # sources and documents seen on this run
+        self.sources = {}
+        self.documents = {}
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "r") as obj:
+            data = json.load(obj)
+
+        if data.get("settings") != self.settings:
+            # archive was built with different settings, so nothing from it can be reused
+            return
+
+        self.previous_sources = data["sources"]
+        self.previous_documents = data["documents"]
+
+    def save(self):
+        data = {"settings": self.settings, "sources": self.sources, "documents": self.documents}
+
+        with open(self.path, "w") as obj:
+            json.dump(data, obj, indent=1, sort_keys=True)
+
+    def source(self, path):
+        """Get current size, modification time and digest of source, or None if it doesn't exist"""
+        if path in self.sources:
+            return self.sources[path]
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        previous = self.previous_sources.get(path)
+
+        if previous is not None and previous["size"] == stat.st_size \
+           and previous["mtime"] == stat.st_mtime_ns:
+            # assume contents are unchanged
+            digest = previous["digest"]
+        else:
+            digest = file_md5(path)
+
+        self.sources[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": digest}
+
+        return self.sources[path]
+
+    def source_changed(self, path):
+        previous = self.previous_sources.get(path)
+
+        if previous is None:
+            # new source
+            return True
+
+        current = self.source(path)
+
+        return current is None or current["digest"] != previous["digest"]
+
+    def document_changed(self, path, response_paths):
+        """Check if document or any of the sources it was parsed from changed since the previous run"""
+        previous = self.previous_documents.get(path)
+
+        if previous is None or previous["responses"] != sorted(response_paths):
+            return True
+
+        return any(self.source_changed(source) for source in previous["sources"])
+
+    def add_document(self, path, response_paths, sources):
+        """Record document parsed from the specified sources on this run"""
+        for source in sources:
+            self.source(source)
+
+        self.documents[path] = {"responses": sorted(response_paths), "sources": sorted(sources),
+                                "outputs": []}
+
+    def keep_document(self, path):
+        """Record unchanged document from the previous run on this run"""
+        self.documents[path] = dict(self.previous_documents[path], outputs=[])
+
+    def add_outputs(self, path, outputs):
+        """Record archive files produced from document"""
+        if path in self.documents:
+            self.documents[path]["outputs"].extend(outputs)
@@ -0,0 +1,202 @@
+import re
+from lxml import etree
+from bs4.builder import HTMLTreeBuilder
+
+# parser setting that selects parsing pages with lxml directly instead of through BeautifulSoup
+NATIVE_LXML_PARSER = "lxml-native"
+
+# page elements, as found by LotusPage when parsing with BeautifulSoup
+LOGBOOK_DIV_XPATH = etree.XPath("descendant::div[@align='center'][1]")
+LOGBOOK_DESCRIPTION_XPATH = etree.XPath("descendant::b[1]/descendant::font[1]")
+META_TABLE_XPATH = etree.XPath("descendant::table[@width='100%'][@border='1'][1]")
+META_ROW_XPATH = etree.XPath("descendant::tr[1]")
+META_FIRST_COLUMN_XPATH = etree.XPath("descendant::td[@bgcolor='#EFEFEF'][@width='1%'][1]")
+META_FIELD_XPATH = etree.XPath("descendant::font[@size='2']")
+TEXT_XPATH = etree.XPath("string()")
+
+# elements that can link to pages or media, and those of them in the content after the meta table
+LINK_TAGS = ("a", "img")
+CONTENT_LINK_XPATH = etree.XPath("following-sibling::*/descendant-or-self::*"
+                                 "[self::a[@href] or self::img[@src]]")
+
+# elements written as empty element tags when they have no contents, attributes whose values are
+# whitespace separated lists and elements whose text isn't escaped, as in BeautifulSoup
+VOID_ELEMENTS = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS
+LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+RAW_TEXT_ELEMENTS = {"script", "style"}
+PRESERVE_WHITESPACE_ELEMENTS = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+
+# whitespace collapsed by BeautifulSoup
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+_ESCAPE_PATTERN = re.compile("[&<>]")
+_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+_WORD_PATTERN = re.compile(r"\S+")
+
+
+def parse_html(markup):
+    """Parse HTML document string into the same tree as BeautifulSoup's lxml tree builder
+
+    The document is built from parser events, as BeautifulSoup does, so that attributes without
+    values are empty rather than set to their names.
+    """
+    parser = etree.HTMLParser(target=etree.TreeBuilder())
+    parser.feed(markup)
+    document = parser.close()
+
+    _collapse_whitespace(document)
+
+    return document
+
+def _collapse(text):
+    if "\n" in text:
+        return "\n"
+
+    return " "
+
+def _preserves_whitespace(element):
+    if element.tag in PRESERVE_WHITESPACE_ELEMENTS:
+        return True
+
+    return next(element.iterancestors(*PRESERVE_WHITESPACE_ELEMENTS), None) is not None
+
+def _collapse_whitespace(document):
+    """Replace strings of only whitespace with a single space or newline, as BeautifulSoup does"""
+    for element in document.iter():
+        if isinstance(element.tag, str) and element.text and not element.text.strip(ASCII_SPACES) \
+           and not _preserves_whitespace(element):
+            element.text = _collapse(element.text)
+
+        parent = element.getparent()
+
+        if element.tail and not element.tail.strip(ASCII_SPACES) \
+           and (parent is None or not _preserves_whitespace(parent)):
+            element.tail = _collapse(element.tail)
+
+def find(xpath, element):
+    """First result of XPath expression evaluated on element, or None"""
+    results = xpath(element)
+
+    if not results:
+        return None
+
+    return results[0]
+
+def set_attribute(element, name, value):
+    """Set attribute of lxml or BeautifulSoup element"""
+    if etree.iselement(element):
+        element.set(name, value)
+    else:
+        element[name] = value
+
+def is_comment(node):
+    return etree.iselement(node) and node.tag is etree.Comment
+
+def following_siblings(element):
+    """Nodes after element with the same parent, like BeautifulSoup's next_siblings
+
+    Text is yielded as strings.
+    """
+    if element.tail:
+        yield element.tail
+
+    for sibling in element.itersiblings():
+        yield sibling
+
+        if sibling.tail:
+            yield sibling.tail
+
+def node_text(node):
+    """Text of node, like BeautifulSoup's text attribute"""
+    if not etree.iselement(node):
+        return node
+    elif is_comment(node):
+        return node.text
+
+    return TEXT_XPATH(node)
+
+def escape(text):
+    """Escape text as BeautifulSoup's minimal formatter does"""
+    return _ESCAPE_PATTERN.sub(lambda match: _ESCAPES[match.group()], text)
+
+def _attribute(element, name, value):
+    if name in LIST_ATTRIBUTES.get("*", ()) or name in LIST_ATTRIBUTES.get(element.tag, ()):
+        # normalise whitespace between values
+        value = " ".join(_WORD_PATTERN.findall(value))
+
+    value = escape(value)
+
+    if '"' in value:
+        if "'" in value:
+            value = value.replace('"', "&quot;")
+        else:
+            return "%s='%s'" % (name, value)
+
+    return '%s="%s"' % (name, value)
+
+def _start(element, parts):
+    """Write start of element, returning whether its contents and end tag are to be written"""
+    if is_comment(element):
+        parts.append("<!--%s-->" % element.text)
+        return False
+    elif not isinstance(element.tag, str):
+        # other special nodes have no representation
+        return False
+
+    attributes = "".join(" " + _attribute(element, name, value)
+                         for name, value in sorted(element.attrib.items()))
+
+    if element.tag in VOID_ELEMENTS and not element.text and not len(element):
+        parts.append("<%s%s/>" % (element.tag, attributes))
+        return False
+
+    parts.append("<%s%s>" % (element.tag, attributes))
+
+    if element.text:
+        parts.append(_text(element, element.text))
+
+    return True
+
+def _text(parent, text):
+    if parent.tag in RAW_TEXT_ELEMENTS:
+        return text
+
+    return escape(text)
+
+def _serialize(root, parts):
+    if not _start(root, parts):
+        return
+
+    # walk the tree without recursion, as content can be nested very deeply
+    stack = [(root, iter(root))]
+
+    while stack:
+        element, children = stack[-1]
+        child = next(children, None)
+
+        if child is None:
+            # end of element
+            stack.pop()
+            parts.append("</%s>" % element.tag)
+
+            if stack and element.tail:
+                parts.append(_text(stack[-1][0], element.tail))
+        elif _start(child, parts):
+            stack.append((child, iter(child)))
+        elif child.tail:
+            parts.append(_text(element, child.tail))
+
+def serialize(node):
+    """Serialise node, excluding its tail, as str() does for BeautifulSoup elements
+
+    Text and comments are returned as their unescaped text, as they are by BeautifulSoup.
+    """
+    if not etree.iselement(node):
+        return node
+    elif is_comment(node):
+        return node.text
+
+    parts = []
+    _serialize(node, parts)
+
+    return "".join(parts)
@@ -6,15 +6,21 @@ import datetime
 import hashlib
 import urllib.parse
 import re
-import shutil
 import pytz
 
-from binaryornot.check import is_binary
 from lxml import etree
-from bs4 import BeautifulSoup, UnicodeDammit
-import magic
+from bs4 import BeautifulSoup, Tag
 
 from .exceptions import PageInvalidException, MediaInvalidException
+from .tools import file_md5, archive_file
+from .sniff import MediaSniffer, BINARY_CHECK_SIZE, is_binary_buffer
+from .decode import decode_markup, describe_removed, strip_control_bytes
+from .store import DirectoryPageStore, archived_page_hash
+from .stats import current as current_stats
+from .markup import (NATIVE_LXML_PARSER, LOGBOOK_DIV_XPATH, LOGBOOK_DESCRIPTION_XPATH, META_TABLE_XPATH,
+                     META_ROW_XPATH, META_FIRST_COLUMN_XPATH, META_FIELD_XPATH, CONTENT_LINK_XPATH,
+                     LINK_TAGS, parse_html, find, following_siblings, node_text, serialize,
+                     set_attribute)
 
 LOGGER = logging.getLogger("lotus")
 
@@ -68,7 +74,8 @@ class LotusObject(object, metaclass=abc.ABCMeta):
 
 
 class LotusPage(LotusObject):
-    def __init__(self, *args, timezone=None, parser=None, response_paths=None, **kwargs):
+    def __init__(self, *args, timezone=None, parser=None, response_paths=None, media_cache_path=None,
+                 **kwargs):
         if timezone is None:
             # assume UTC
             timezone = pytz.UTC
@@ -78,6 +85,8 @@ class LotusPage(LotusObject):
 
         self.timezone = timezone
         self.parser = parser
+        # path to media hash and MIME type cache
+        self.media_cache_path = media_cache_path
         
         if response_paths is None:
             response_paths = []
@@ -93,32 +102,80 @@ class LotusPage(LotusObject):
         self.created = None
         self.content = None
         self.urls = {}
+        # characters removed from the page's file, and their counts
+        self.removed_characters = {}
         self.attachments = {}
         self.images = {}
 
+        # links to media found while parsing content, resolved once all content is parsed
+        self._media_links = []
+
+        # timings and counts recorded while parsing, until added to the builder's statistics
+        self.stats = None
+
         # fields
-        self._hash_filename = None
+        self._unique_hash = None
+        self._fingerprint = None
 
         super().__init__(*args, **kwargs)
 
     def parse(self):
         """Parse file at path as a page"""
+        stats = current_stats()
+
+        with stats.timer("page.read"):
+            with open(self.path, 'rb') as obj:
+                data = obj.read()
 
-        # check if file can be parsed
-        if is_binary(self.path):
+        stats.add_bytes("pages_read", len(data))
+
+        # check if file can be parsed, ignoring stray control characters as they are removed below
+        if is_binary_buffer(strip_control_bytes(data[:BINARY_CHECK_SIZE])):
             raise PageInvalidException()
 
-        with open(self.path, 'r') as obj:
+        # decode as UTF-8 or windows-1252, removing characters that can't be archived in XML
+        with stats.timer("page.decode"):
+            markup, encoding, self.removed_characters = decode_markup(data)
+
+        if self.removed_characters:
+            LOGGER.warning("removed characters not allowed in XML from %s: %s", self.path,
+                           describe_removed(self.removed_characters))
+
+        # parse file as HTML document
+        with stats.timer("page.parse_html"):
+            document = self.parse_markup(markup)
+
+        with stats.timer("page.extract"):
+            if etree.iselement(document):
+                self.parse_lxml_document(document)
+            else:
+                self.parse_document(document)
+
+        # parse responses
+        for response_path in self.response_paths:
+            response = self.__class__(response_path, self.base_archive_dir, timezone=self.timezone,
+                                      parser=self.parser, media_cache_path=self.media_cache_path)
+            self.response_pages.append(response)
+
+            # add data to parent
+            self.images = {**response.images, **self.images}
+            self.attachments = {**response.attachments, **self.attachments}
+            self.urls = {**response.urls, **self.urls}
+
+    def parse_markup(self, markup):
+        """Parse HTML markup with the configured parser"""
+        if self.parser == NATIVE_LXML_PARSER:
             try:
-                # read contents
-                file_contents = obj.read()
+                return parse_html(markup)
+            except (etree.XMLSyntaxError, ValueError):
+                # lxml can't build trees containing some names and characters, but BeautifulSoup can
+                LOGGER.debug("falling back to BeautifulSoup to parse %s", self.path)
+                return BeautifulSoup(markup, "lxml")
 
-                # parse file as HTML document, converting to unicode
-                dammit = UnicodeDammit(file_contents, ['windows-1252'])
-                document = BeautifulSoup(dammit.unicode_markup, self.parser)
-            except UnicodeDecodeError as e:
-                raise PageInvalidException(e)
+        return BeautifulSoup(markup, self.parser)
 
+    def parse_document(self, document):
+        """Parse page document parsed by BeautifulSoup"""
         # document should say "Logbook Entry" in a centered div
         logbook_entry_txt = document.find("div", align="center")
 
@@ -142,16 +199,29 @@ class LotusPage(LotusObject):
         # this is anything after the table
         self.parse_content(meta_table.next_siblings)
 
-        # parse responses
-        for response_path in self.response_paths:
-            response = self.__class__(response_path, self.base_archive_dir, timezone=self.timezone,
-                                      parser=self.parser)
-            self.response_pages.append(response)
+    def parse_lxml_document(self, document):
+        """Parse page document parsed by lxml"""
+        # document should say "Logbook Entry" in a centered div
+        logbook_entry_txt = find(LOGBOOK_DIV_XPATH, document)
 
-            # add data to parent
-            self.images = {**response.images, **self.images}
-            self.attachments = {**response.attachments, **self.attachments}
-            self.urls = {**response.urls, **self.urls}
+        if logbook_entry_txt is None:
+            raise PageInvalidException("couldn't find logbook description")
+
+        description = find(LOGBOOK_DESCRIPTION_XPATH, logbook_entry_txt)
+
+        # check description reads "Logbook Entry"
+        if description is None:
+            raise PageInvalidException("couldn't find logbook description field")
+        elif node_text(description) != "Logbook Entry":
+            raise PageInvalidException("document description doesn't read \"Logbook Entry\"")
+
+        # extract title, page number, etc. from first table
+        meta_table = find(META_TABLE_XPATH, document)
+        self.parse_lxml_table_meta(meta_table)
+
+        # extract content
+        # this is anything after the table
+        self.parse_lxml_content(meta_table)
 
     def parse_table_meta(self, table):
         if table is None:
@@ -178,24 +248,50 @@ class LotusPage(LotusObject):
         # data is all contained in font tags
         font_tags = second_column.find_all("font", size="2")
 
-        # page title
-        self.title = font_tags[1].text
+        self.set_meta(font_tags[1].text, font_tags[3].text, font_tags[5].text, font_tags[7].text,
+                      time_str)
+
+    def parse_lxml_table_meta(self, table):
+        if table is None:
+            raise PageInvalidException("invalid table tag")
+
+        # everything in this table is contained in a single tr
+        container = find(META_ROW_XPATH, table)
 
-        # page author(s)
-        authors = font_tags[3].text
+        # first column contains page number, created and modified dates
+        first_column = find(META_FIRST_COLUMN_XPATH, container)
+
+        # page number field
+        page_number_field = find(META_FIELD_XPATH, first_column)
+        page_number_siblings = list(following_siblings(page_number_field))
+
+        # page number is next sibling
+        # NOTE: not necessarily integer!
+        self.page = node_text(page_number_siblings[0])
+
+        # grab time out of "Created" field (but not used for date as this is not fully qualified)
+        time_str = node_text(page_number_siblings[4])
+
+        # second column contains title, author, categories and date
+        second_column = next(following_siblings(first_column))
+
+        # data is all contained in font tags
+        font_tags = META_FIELD_XPATH(second_column)
+
+        self.set_meta(node_text(font_tags[1]), node_text(font_tags[3]), node_text(font_tags[5]),
+                      node_text(font_tags[7]), time_str)
+
+    def set_meta(self, title, authors, categories, date_str, time_str):
+        """Set metadata from the text of the fields in the page's meta table"""
+        # page title
+        self.title = title
 
         # split authors by commas
         self.authors = [author.strip() for author in authors.split(",") if author != ""]
 
-        # page categories
-        categories = font_tags[5].text
-
         # split categories by commas
         self.categories = [category.strip() for category in categories.split(",") if category != ""]
 
-        # diary date
-        date_str = font_tags[7].text # "Diary date"
-
         # time, without date part
         time_str = time_str.split()
         time_str = " ".join(time_str[1:])
@@ -213,92 +309,132 @@ class LotusPage(LotusObject):
     def parse_content(self, elements):
         """Parse specified elements as the page content"""
         
-        # empty page content
-        lines = []
+        # content elements
+        content_elements = []
 
         for element in elements:
             if element.name == "a" and element.text == "top" and element.has_attr("href") and element["href"].endswith("#top"):
                 # skip link to top
                 continue
 
-            self.parse_element(element)
-            # add elements to document content
-            lines.append(str(element))
+            content_elements.append(element)
 
-        self.content = "".join(lines)
-    
-    def parse_element(self, element):
-        """Parse element"""
+            if not isinstance(element, Tag):
+                # this is a string
+                continue
 
-        self.extract_references(element)
+            if element.name in LINK_TAGS:
+                self.extract_tag_references(element.name, element)
 
-        if hasattr(element, 'children'):
-            for child in element.children:
-                self.parse_element(child)
+            # find links within element
+            for link in element.find_all(LINK_TAGS):
+                self.extract_tag_references(link.name, link)
 
-    def extract_references(self, element):
-        """Find page or media links in element"""
+        # replace media links before the elements are serialised
+        self.parse_media_links()
 
-        if not hasattr(element, 'contents'):
-            # this is not a tag
-            return
+        # add elements to document content
+        self.content = "".join(str(element) for element in content_elements)
+
+    def parse_lxml_content(self, meta_table):
+        """Parse lxml elements and strings after the meta table as the page content"""
+
+        # content nodes
+        content_nodes = []
+        # links within skipped nodes
+        skipped_links = set()
+
+        for node in following_siblings(meta_table):
+            if etree.iselement(node) and node.tag == "a" and node_text(node) == "top" and node.get("href", "").endswith("#top"):
+                # skip link to top
+                skipped_links.update(node.iter(*LINK_TAGS))
+                continue
+
+            content_nodes.append(node)
+
+        # find links in content with a single query
+        for element in CONTENT_LINK_XPATH(meta_table):
+            if element not in skipped_links:
+                self.extract_tag_references(element.tag, element)
+
+        # replace media links before the elements are serialised
+        self.parse_media_links()
+
+        # add nodes to document content
+        self.content = "".join(serialize(node) for node in content_nodes)
+    
+    def extract_tag_references(self, name, element):
+        """Find page or media links in BeautifulSoup or lxml element with the specified tag name"""
+
+        href = element.get("href")
 
         # check for cross-referencing links
-        if element.name == "a" and element.has_attr("href"):
-            if element["href"].endswith("OpenDocument"):
+        if name == "a" and href is not None:
+            if href.endswith("OpenDocument"):
                 # replace this internal link
                 self.extract_cross_reference(element)
-            elif "$FILE" in element["href"]:
+            elif "$FILE" in href:
                 # replace this attached file
                 self.extract_attachment(element)
         # check for embedded images
-        elif element.name == "img" and element.has_attr("src"):
+        elif name == "img" and element.get("src") is not None:
             # replace this embedded image
             self.extract_image(element)
 
     def extract_cross_reference(self, element):
         # get path relative to root
-        path = self.full_url_path(element["href"])
+        path = self.full_url_path(element.get("href"))
 
         # generate unique id
         key = path_hash(path)
 
         # replace URL with unique ID
-        element["href"] = key
+        set_attribute(element, "href", key)
 
         self.urls[key] = path
 
     def extract_attachment(self, element):
         # get path relative to root
-        path = self.full_url_path(element["href"])
+        path = self.full_url_path(element.get("href"))
 
-        try:
-            media = LotusMedia(created=self.created, path=path, archive_dir=self.archive_dir)
-        except MediaInvalidException:
-            # not attachment
-            return
-
-        # replace URL with unique ID
-        element["href"] = media.file_hash
-
-        LOGGER.debug("found attachment %s" % media)
-        self.attachments[media.file_hash] = media
+        self._media_links.append((element, "href", path, "attachment"))
 
     def extract_image(self, element):
         # get path relative to root
-        path = self.full_url_path(element["src"])
+        path = self.full_url_path(element.get("src"))
+
+        self._media_links.append((element, "src", path, "image"))
 
-        try:
-            media = LotusMedia(created=self.created, path=path, archive_dir=self.archive_dir)
-        except MediaInvalidException:
-            # not image
+    def parse_media_links(self):
+        """Parse media linked from content, replacing links with unique IDs"""
+        if not self._media_links:
             return
 
-        # replace URL with unique ID
-        element["src"] = media.file_hash
+        # hash and identify the files together, and give the results to the media objects below
+        paths = list(dict.fromkeys(path for _, _, path, _ in self._media_links))
+
+        with current_stats().timer("media.sniff"):
+            sniffed = dict(zip(paths, MediaSniffer.shared(self.media_cache_path).sniff_many(paths)))
 
-        LOGGER.debug("found image %s" % media)
-        self.images[media.file_hash] = media
+        for element, attribute, path, kind in self._media_links:
+            try:
+                media = LotusMedia(created=self.created, path=path, archive_dir=self.archive_dir,
+                                   cache_path=self.media_cache_path, sniffed=sniffed[path])
+            except MediaInvalidException:
+                # not media
+                continue
+
+            # replace URL with unique ID
+            set_attribute(element, attribute, media.file_hash)
+
+            LOGGER.debug("found %s %s", kind, media)
+
+            if kind == "attachment":
+                self.attachments[media.file_hash] = media
+            else:
+                self.images[media.file_hash] = media
+
+        self._media_links = []
 
     def full_url_path(self, path):
         """Return full path for URL, decoding any entities"""
@@ -311,11 +447,22 @@ class LotusPage(LotusObject):
 
         return path
 
-    def archive(self):
-        """Archive page"""
+    def archive(self, store=None):
+        """Archive page in store, or as a file in the archive directory if not specified"""
+
+        LOGGER.debug("archiving page '%s' (%s)", self.title, self.path)
+
+        if store is None:
+            store = DirectoryPageStore(self.archive_dir)
 
-        LOGGER.info("archiving page '%s' (%s)" % (self.title, self.path))
+        # save, unless an identical page was archived previously
+        if store.write_element(self.unique_hash, self.to_xml()):
+            LOGGER.debug("wrote page '%s' as %s", self.title, self.unique_hash)
+        else:
+            LOGGER.debug("page '%s' unchanged as %s", self.title, self.unique_hash)
 
+    def to_xml(self):
+        """Archived XML element of page"""
         # create XML tree
         page = etree.Element("page")
 
@@ -346,24 +493,24 @@ class LotusPage(LotusObject):
         # add attachments
         attachments = etree.SubElement(page, "attachments")
 
-        for unique_hash, attachment in self.attachments.items():
-            etree.SubElement(attachments, "attachment", path=attachment.archive_path).text = unique_hash
+        for attachment in self.attachments.values():
+            attachments.append(attachment.to_xml("attachment"))
 
         # add images
         images = etree.SubElement(page, "images")
 
-        for unique_hash, image in self.images.items():
-            etree.SubElement(images, "image", path=image.archive_path).text = unique_hash
+        for image in self.images.values():
+            images.append(image.to_xml("image"))
 
         # add urls
         urls = etree.SubElement(page, "urls")
 
-        for unique_hash, other_page in self.urls.items():
-            if other_page is None:
+        for unique_hash, other_archive_path in self.urls.items():
+            if other_archive_path is None:
                 # skip not found page
                 continue
 
-            etree.SubElement(urls, "url", path=other_page.archive_path).text = unique_hash
+            etree.SubElement(urls, "url", path=other_archive_path).text = unique_hash
 
         # add responses
         responses = etree.SubElement(page, "responses")
@@ -383,29 +530,42 @@ class LotusPage(LotusObject):
             # add encoded content
             etree.SubElement(response, "content").text = etree.CDATA(response_page.content)
 
-        # save pretty version
-        tree = etree.ElementTree(page)
-        tree.write(self.archive_path, encoding="utf-8", xml_declaration=True)
+        return page
+
+    def index_entry(self):
+        """Metadata of page for the page index"""
+        media_hashes = set(self.attachments) | set(self.images)
+        linked_hashes = set(archived_page_hash(path) for path in self.urls.values()
+                            if path is not None)
 
-        LOGGER.debug("wrote page '%s' to %s", self.title, self.archive_path)
+        return {"page": self.page,
+                "title": self.title,
+                "created": round(self.created.timestamp()),
+                # decoded as in the archived page
+                "authors": [urllib.parse.unquote(author) for author in self.authors],
+                "categories": [urllib.parse.unquote(category) for category in self.categories],
+                "media": sorted(media_hashes),
+                "urls": sorted(linked_hashes)}
 
     @property
     def archive_path(self):
         return os.path.join(self.archive_dir, self.hash_filename)
 
     @property
-    def hash_filename(self):
-        if self._hash_filename is None:
+    def unique_hash(self):
+        if self._unique_hash is None:
             # unique hash of this object
             # can't just use hash(self) as filename as this is sometimes negative and not stable between
             # kernel instances
             #unique_hash = path_hash(self.path)
-            unique_hash = hashlib.md5(str(hash(self)).encode('utf-8')).hexdigest()
+            self._unique_hash = hashlib.md5(repr(self.fingerprint).encode('utf-8')).hexdigest()
 
-            # XML filename
-            self._hash_filename = "%s.xml" % unique_hash
-        
-        return self._hash_filename
+        return self._unique_hash
+
+    @property
+    def hash_filename(self):
+        # XML filename
+        return "%s.xml" % self.unique_hash
 
     @property
     def archive_dir(self):
@@ -416,6 +576,19 @@ class LotusPage(LotusObject):
         yield from self.attachments
         yield from self.images
 
+    @property
+    def fingerprint(self):
+        """Metadata identifying this page, used to detect duplicates
+
+        This is computed once, after the page has been parsed.
+        """
+        if self._fingerprint is None:
+            # authors and categories are sorted so the fingerprint doesn't depend on their order
+            self._fingerprint = (self.title, tuple(sorted(set(self.authors))),
+                                 tuple(sorted(set(self.categories))), str(self.created))
+
+        return self._fingerprint
+
     def __str__(self):
         return self.title
 
@@ -424,16 +597,23 @@ class LotusPage(LotusObject):
         #return self.title == other.title and self.page == other.page and \
         #       self.authors == other.authors and self.categories == other.categories and \
         #       self.created == other.created
-        return hash(self) == hash(other)
+        return self.fingerprint == other.fingerprint
     
     def __hash__(self):
-        return hash((self.title, frozenset(self.authors), frozenset(self.categories), str(self.created)))
+        return hash(self.fingerprint)
 
 
 class LotusMedia(LotusObject):
-    def __init__(self, created, *args, **kwargs):        
+    def __init__(self, created, *args, cache_path=None, sniffed=None, **kwargs):
         # media data
         self.mime_type = None
+        # hash and MIME type, and whether they were found in the cache, if already sniffed
+        self._sniffed = sniffed
+
+        # path to hash and MIME type cache
+        self.cache_path = cache_path
+        # whether hash and MIME type were found in the cache (None if not looked up)
+        self.from_cache = None
 
         # archive path
         self._archive_path = None
@@ -449,30 +629,20 @@ class LotusMedia(LotusObject):
     def parse(self):
         """Parse file at path as media"""
 
-        LOGGER.debug("getting mime type")
-        self.mime_type = magic.from_file(self.path, mime=True)
-        
-        # force file hash to be computed
-        _ = self.file_hash
+        if self._sniffed is None:
+            LOGGER.debug("getting hash and mime type")
+            self._sniffed = MediaSniffer.shared(self.cache_path).sniff(self.path)
+
+        (self._file_hash, self.mime_type), known = self._sniffed
+
+        if self.cache_path is not None:
+            self.from_cache = known
 
     @property
     def file_hash(self):
         if self._file_hash is None:
             LOGGER.debug("computing MD5 hash")
-
-            md5 = hashlib.md5()
-
-            with open(self.path, 'rb') as obj:
-                while True:
-                    data = obj.read(1048576)
-
-                    if not data:
-                        # end of file
-                        break
-                    
-                    md5.update(data)
-                
-            self._file_hash = md5.hexdigest()
+            self._file_hash = file_md5(self.path)
         
         return self._file_hash
 
@@ -481,13 +651,48 @@ class LotusMedia(LotusObject):
         _, ext = os.path.splitext(self.sanitised_filename)
         return self.file_hash + ext.lower()
 
-    def archive(self):
-        """Archive media file"""
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def to_xml(self, tag):
+        """Archived XML element of media, for pages it's attached to (tag "attachment") or
+        embedded in (tag "image")
+
+        The creation time, which is also set as the archived file's modification time, size, MIME
+        type and filename are recorded so the file doesn't have to be read again.
+        """
+        element = etree.Element(tag, path=self.archive_path,
+                                created=str(round(self.created.timestamp())),
+                                size=str(self.size), mime=self.mime_type or "",
+                                filename=self.sanitised_filename)
+        element.text = self.file_hash
 
-        LOGGER.info("archiving media '%s' (%s)" % (self.file_hash, self.path))
+        return element
 
-        # copy file to archive
-        shutil.copyfile(self.path, self.archive_path)
+    def archive(self, strategy="copy"):
+        """Archive media file
+
+        Returns the method used to archive the file (see tools.archive_file), or "existing" if it
+        was already archived, and the number of bytes copied.
+        """
+
+        LOGGER.debug("archiving media '%s' (%s)", self.file_hash, self.path)
+
+        # archive filename is the content hash, so an existing file of the same size is this file
+        if os.path.isfile(self.archive_path) and \
+           os.path.getsize(self.archive_path) == os.path.getsize(self.path):
+            LOGGER.debug("media '%s' already archived", self.file_hash)
+            method, ncopied = "existing", 0
+        else:
+            # copy file to archive
+            method, ncopied = archive_file(self.path, self.archive_path, strategy)
+            LOGGER.debug("archived media '%s' by %s", self.file_hash, method)
+
+        if os.path.samefile(self.archive_path, self.path):
+            # hard linked, so setting the times would change the scraped file, and with it the
+            # source manifest and media cache; the creation time is kept in the page XML instead
+            return method, ncopied
 
         # modification timestamp, in seconds
         mod_timestamp = round(self.created.timestamp())
@@ -495,6 +700,8 @@ class LotusMedia(LotusObject):
         # set modification and access times
         os.utime(self.archive_path, times=(mod_timestamp, mod_timestamp))
 
+        return method, ncopied
+
     @property
     def archive_path(self):
         #if self._archive_path is None:
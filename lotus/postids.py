@@ -0,0 +1,91 @@
+import os
+import json
+
+
+class PostIdAllocator:
+    """Allocates unique WordPress post ids to pages and media
+
+    Ids can be claimed, e.g. to keep Lotus page numbers, and other ids are allocated above the
+    highest id in use. If a path is specified, the id of each page and media file is saved there,
+    and the same ids are given to them on the next run, so regenerated import files don't renumber
+    posts that have already been imported. Ids from previous runs can also be specified, and take
+    precedence over those in the file. Ids saved for pages and media that no longer exist stay
+    reserved.
+    """
+
+    def __init__(self, path=None, previous=None):
+        self.path = path
+
+        # ids in use or reserved, and the highest of them
+        self.used = set()
+        self.maximum = 0
+
+        # keys (page hashes, or media kinds and filenames) -> ids, saved on previous runs and given on this run
+        self.previous = {}
+        self.ids = {}
+
+        if self.path is not None and os.path.isfile(self.path):
+            with open(self.path, "r") as obj:
+                self.previous = json.load(obj)
+
+        if previous is not None:
+            self.previous.update(previous)
+
+        for post_id in self.previous.values():
+            self._use(post_id)
+
+    def _use(self, post_id):
+        self.used.add(post_id)
+
+        if post_id > self.maximum:
+            self.maximum = post_id
+
+    def previous_id(self, key):
+        """Id given to key on a previous run, or None"""
+        return self.previous.get(key)
+
+    def claim(self, key, post_id):
+        """Give key the specified id if it isn't in use, returning whether it was given"""
+        if post_id in self.used:
+            return False
+
+        self._use(post_id)
+        self.ids[key] = post_id
+
+        return True
+
+    def allocate(self, key):
+        """Give key the id it had on a previous run, or else a new one"""
+        if key in self.ids:
+            return self.ids[key]
+
+        post_id = self.previous.get(key)
+
+        if post_id is None:
+            post_id = self.maximum + 1
+
+        self._use(post_id)
+        self.ids[key] = post_id
+
+        return post_id
+
+    def all_ids(self):
+        """Ids given on previous runs and on this run"""
+        ids = dict(self.previous)
+        ids.update(self.ids)
+
+        return ids
+
+    def save(self):
+        if self.path is None:
+            return
+
+        ids = self.all_ids()
+
+        # replaced atomically, so ids are never lost if writing is interrupted
+        temporary_path = "%s.%i.tmp" % (self.path, os.getpid())
+
+        with open(temporary_path, "w") as obj:
+            json.dump(ids, obj, indent=0, sort_keys=True)
+
+        os.replace(temporary_path, self.path)
@@ -1,72 +1,185 @@
 import os
+import glob
 import shutil
+import shelve
 import urllib
-import glob
-import logging
 import urllib.parse
+from functools import partial
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from lxml import etree
-from bs4 import BeautifulSoup, UnicodeDammit
 
-from .tools import working_directory
-from .objects import LotusPage
+from .tools import ARCHIVE_STRATEGIES
+from .objects import LotusPage, LotusMedia
+from .manifest import SourceManifest
+from .contents import scan_contents_page
+from .discovery import FileIndex
+from .cache import MediaCache
+from .sniff import MediaSniffer
+from .store import PAGE_ARCHIVES, MemoryPageStore, PageIndex, open_page_store
+from .stats import Stats, Progress, collecting
+from .logs import setup_logging
+
+
+def _parse_page(path, response_paths, archive_dir, timezone, parser, media_cache_path):
+    """Parse page at path, with the statistics recorded while parsing it
+
+    This is a module level function so that it can be sent to worker processes.
+    """
+    with collecting() as stats:
+        page = LotusPage(path, archive_dir, response_paths=response_paths, timezone=timezone,
+                         parser=parser, media_cache_path=media_cache_path)
+
+    page.stats = stats
+
+    return page
+
+def _scan_contents_page(path):
+    """Scan contents page at path, returning its links and the statistics recorded while scanning"""
+    with collecting() as stats:
+        with stats.timer("contents.scan"):
+            links = scan_contents_page(path)
+
+    return links, stats
 
 
 class LotusXMLBuilder:
+    # files in meta directory that are kept when the archive is rebuilt
+    CACHE_FILENAMES = ("files.json", "media.sqlite", "media.sqlite-wal", "media.sqlite-shm")
+    # version of cached pages, changed when pages parsed by a previous version can't be reused
+    PAGE_CACHE_VERSION = 2
+    # largest number of pages sent to a worker process at once
+    MAX_CHUNK_SIZE = 16
+
     def __init__(self, root_dir, root_contents_wildcard, archive_dir, timezone=None, parser="lxml",
-                 debug_log_file=None):        
+                 debug_log_file=None, jobs=None, incremental=False, media_cache=True,
+                 archive_strategy="copy", streaming=False, page_archive="directory",
+                 stats_file=None, quiet=None, archive_pages=True):
         self.root_dir = root_dir
         self.root_contents_wildcard = root_contents_wildcard
         self.archive_dir = archive_dir
         self.timezone = timezone
         self.parser = parser
+        # number of worker processes to parse pages with (None or 1 for no parallelism)
+        self.jobs = jobs
+        # reuse unchanged pages and archive files from the previous run instead of rebuilding
+        self.incremental = incremental
+        # cache media hashes and MIME types between runs
+        self.media_cache = media_cache
+
+        if archive_strategy not in ARCHIVE_STRATEGIES:
+            raise ValueError("archive strategy must be one of %s" % ", ".join(ARCHIVE_STRATEGIES))
+
+        # how to archive media: "copy", "reflink" (or copy_file_range) or "hardlink"
+        self.archive_strategy = archive_strategy
+        # archive each page as soon as it is parsed instead of holding all pages in memory
+        self.streaming = streaming
+
+        if page_archive not in PAGE_ARCHIVES:
+            raise ValueError("page archive must be one of %s" % ", ".join(PAGE_ARCHIVES))
+
+        # how to store archived pages: "directory" of XML files or "packed" into a single file
+        self.page_archive = page_archive
+        # write pages to the page archive (if not, they are only kept in memory for convert)
+        self.archive_pages = archive_pages
 
         # parsed pages
         self.pages = []
         # map of duplicate page paths to originals
-        # (this also includes non-duplicate pages mapped to themselves)
+        # (this also includes non-duplicate pages mapped to themselves; in streaming mode, this is
+        # kept on disk during dump and maps to the originals' archive paths)
         self.page_paths = {}
         # orphaned pages not found on contents but linked from other documents
         self.orphaned_pages = []
+        # map of page fingerprints to paths of first occurrences
+        self.original_pages = {}
+
+        # manifest of source files and cache of pages parsed from them (incremental mode only)
+        self.manifest = None
+        self.page_cache = None
 
-        self._setup_logging(debug_log_file)
-
-    def _setup_logging(self, debug_log_file):
-        # base logger
-        self.logger = logging.getLogger("lotus")
-        self.logger.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(name)-25s - %(levelname)-8s - %(message)s")
-
-        # log INFO or higher to stdout
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(formatter)
-        stream_handler.setLevel(logging.INFO)
-        self.logger.addHandler(stream_handler)
-
-        if debug_log_file is not None:
-            # delete existing log file
-            if os.path.exists(debug_log_file):
-                os.remove(debug_log_file)
-                
-            # log DEBUG or higher to file
-            file_handler = logging.FileHandler(debug_log_file)
-            file_handler.setFormatter(formatter)
-            file_handler.setLevel(logging.DEBUG)
-            self.logger.addHandler(file_handler)
+        # index of files in root directory
+        self.file_index = None
+
+        # store of archived pages (during dump only)
+        self.page_store = None
+
+        # media cache lookups for pages parsed on this run
+        self.media_cache_hits = 0
+        self.media_cache_misses = 0
+
+        # timings and counts of each stage, and path to write them to at the end of a dump (JSON,
+        # or Prometheus text format if the path ends with .prom)
+        self.stats = Stats()
+        self.stats_file = stats_file
+
+        self.logger = setup_logging(debug_log_file, quiet=quiet)
 
     def _make_archive_dir(self):
-        # delete everything in archive directories
-        if os.path.exists(self.archive_dir):
-            shutil.rmtree(self.archive_dir)
+        if not self.incremental and os.path.exists(self.archive_dir):
+            # delete everything in archive directories, except caches
+            for entry in os.scandir(self.archive_dir):
+                if entry.name == "meta" and entry.is_dir(follow_symlinks=False):
+                    for meta_entry in os.scandir(entry.path):
+                        if meta_entry.name not in self.CACHE_FILENAMES:
+                            self._remove(meta_entry)
+                else:
+                    self._remove(entry)
 
         # create archive directory structure
-        os.mkdir(os.path.join(self.archive_dir))
-        os.mkdir(os.path.join(self.archive_dir, 'meta'))
-        os.mkdir(os.path.join(self.archive_dir, 'pages'))
-        os.mkdir(os.path.join(self.archive_dir, 'pages', 'media'))
+        os.makedirs(self.media_archive_dir, exist_ok=True)
+        os.makedirs(os.path.join(self.archive_dir, 'meta'), exist_ok=True)
 
     @staticmethod
-    def _absolute_path(path):
-        return os.path.normpath(os.path.join(os.getcwd(), urllib.parse.unquote(path)))
+    def _remove(entry):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+    @property
+    def page_archive_dir(self):
+        return os.path.join(self.archive_dir, "pages")
+
+    @property
+    def media_archive_dir(self):
+        return os.path.join(self.archive_dir, "pages", "media")
+
+    @property
+    def manifest_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "manifest.json")
+
+    @property
+    def page_cache_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "pages")
+
+    @property
+    def media_cache_filepath(self):
+        if not self.media_cache:
+            return None
+
+        return os.path.join(self.archive_dir, "meta", "media.sqlite")
+
+    @property
+    def page_paths_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "page-paths")
+
+    @property
+    def unresolved_urls_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "unresolved-urls")
+
+    @property
+    def page_index_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "page-index.json")
+
+    @property
+    def file_index_filepath(self):
+        return os.path.join(self.archive_dir, "meta", "files.json")
+
+    def _absolute_path(self, path):
+        """Absolute path of URL relative to root directory"""
+        return os.path.normpath(os.path.join(os.path.abspath(self.root_dir),
+                                             urllib.parse.unquote(path)))
 
     @property
     def authors(self):
@@ -76,7 +189,8 @@ class LotusXMLBuilder:
             for response in page.response_pages:
                 authors.update(response.authors)
         
-        return authors
+        # sorted, so they are listed in the same order on every run
+        return sorted(authors)
 
     @property
     def author_archive_filepath(self):
@@ -90,7 +204,8 @@ class LotusXMLBuilder:
             for response in page.response_pages:
                 categories.update(response.categories)
         
-        return categories
+        # sorted, so they are listed in the same order on every run
+        return sorted(categories)
     
     @property
     def category_archive_filepath(self):
@@ -98,234 +213,659 @@ class LotusXMLBuilder:
 
     @property
     def _documents_relative_to_contents(self):
-        with working_directory(self.root_dir):
-            return glob.iglob("**/*?OpenDocument*", recursive=True)
+        return self.file_index.paths("document")
 
-    def read(self):
-        self._make_archive_dir()
+    def _index_files(self):
+        """Index files in root directory, reusing the index from the previous run where possible"""
+        self.logger.info("Indexing files in %s", self.root_dir)
 
-        with working_directory(self.root_dir):
-            # running list of parsed urls
-            parsed_urls = set()
-            extra_pages = []
-
-            # dict of page dicts
-            pages_info = {}
-
-            root_contents_pages = glob.glob(self.root_contents_wildcard)
-            total_contents_pages = len(root_contents_pages)
-
-            for j, contents_page in enumerate(root_contents_pages, start=1):
-                self.logger.info("Reading contents page %i/%i", j, total_contents_pages)
-
-                with open(contents_page, "r") as obj:
-                    self.logger.info("Reading %s", contents_page)
-
-                    # read contents
-                    file_contents = obj.read()
-
-                    # parse file as HTML document, converting to unicode
-                    dammit = UnicodeDammit(file_contents, ['windows-1252'])
-                    document = BeautifulSoup(dammit.unicode_markup, self.parser)
-
-                # search document for pages
-                page_links = document.findAll("a", target="NotesView")
-
-                current_page_key = ()
-
-                for page_link in page_links:
-                    page_title = page_link.text
-                    
-                    if page_title.startswith("---------- Respond:"):
-                        # link is a response
-                        if not current_page_key:
-                            # this is a response without a parent - ignore
-                            self.logger.warning("Ignoring orphaned response at %s", page_link["href"])
-                        elif page_link["href"] not in pages_info[current_page_key]["response_urls"]:
-                            pages_info[current_page_key]["response_urls"].add(page_link["href"])
-                            
-                            self.logger.info("Found response to page '%s' (p%i)",
-                                             pages_info[current_page_key]["title"],
-                                             pages_info[current_page_key]["number"])
-                    else:
-                        # jump over elements until we get to page number
-                        page_number = int(page_link.next.next.next.next.next.next.next.string)
+        with self.stats.timer("files.index"):
+            self.file_index.update()
+            self.file_index.save()
 
-                        # page dict key
-                        current_page_key = tuple((page_title, page_number))
+        self.logger.info("Indexed %i files", len(self.file_index.paths()))
 
-                        if current_page_key not in pages_info:
-                            # this page hasn't been seen before
-                            pages_info[current_page_key] = {"title": page_title,
-                                                            "number": page_number,
-                                                            "url": page_link["href"],
-                                                            "response_urls": set()}
+    def _scan_contents_pages(self, paths):
+        """Scan contents pages at paths for links, yielding the links in each page in order"""
+        if self.jobs is None or self.jobs <= 1:
+            yield from self._merge_stats(map(_scan_contents_page, paths))
+            return
 
-                            self.logger.info("Found page '%s' (p%i)", page_title, page_number)
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            yield from self._merge_stats(executor.map(_scan_contents_page, paths))
 
-                    # store decoded URL
-                    parsed_urls.add(urllib.parse.unquote(page_link["href"]))
+    def _merge_stats(self, results):
+        """Add statistics returned with results to this builder's, yielding the results"""
+        for result, stats in results:
+            self.stats.merge(stats)
+            yield result
 
-            # parse remaining pages not on the contents - this is necessary because there are
-            # duplicate pages with different URLs... which is stupid :-/
-            for page_link in self._documents_relative_to_contents:
-                if page_link in parsed_urls:
-                    # skip
-                    continue
-                
-                extra_pages.append(page_link)                
-                parsed_urls.add(page_link)
+    def _find_original(self, page):
+        """Get path of the first page parsed with the same fingerprint as page
+
+        If page is the first, it is registered as the original and its own path is returned.
+        """
+        original_path = self.original_pages.setdefault(page.fingerprint, page.path)
 
-            # total number of pages found
-            total = len(pages_info)
-            total_extra = len(extra_pages)
+        if original_path != page.path:
+            # this is a duplicate
+            self.logger.warning("path %s is a duplicate of %s", page.path, original_path)
+            self.stats.count("duplicates")
 
-            # loop over pages in reverse (to get chronological order)
-            for count, page_info in enumerate(reversed(list(pages_info.values())), 1):
-                self.logger.info("%i / %i reading %s (p%s) with %i response(s)",
-                                 count, total, page_info["title"], page_info["number"],
-                                 len(page_info["response_urls"]))
+        return original_path
 
-                # convert paths to absolute, local links
-                main_path = self._absolute_path(page_info["url"])
-                response_paths = [self._absolute_path(response_path) for response_path in page_info["response_urls"]]
+    def _page_target(self, page):
+        """Value mapped to original page in page_paths"""
+        if self.streaming:
+            # only the archive path is kept, so the page itself can be released
+            return page.archive_path
 
-                # parse main document
-                page = LotusPage(main_path, self.archive_dir, response_paths=response_paths,
-                                 timezone=self.timezone, parser=self.parser)
+        return page
 
-                self.logger.info("parsed %s" % page)
+    def _original_archive_path(self, path):
+        """Archive path of the original of the page at path, or None if it hasn't been parsed"""
+        original = self.page_paths.get(path)
 
-                if page in self.pages:
-                    # this is a duplicate
-                    # get first occurrance
-                    original = self.pages[self.pages.index(page)]
+        if original is None or self.streaming:
+            return original
 
-                    self.logger.warning("path %s is a duplicate of %s" % (page.path, original.path))
+        return original.archive_path
+
+    @staticmethod
+    def _page_sources(page):
+        """Paths of source files the page was parsed from"""
+        sources = [page.path]
+        sources.extend(response_page.path for response_page in page.response_pages)
+        sources.extend(media.path for media in page.attachments.values())
+        sources.extend(media.path for media in page.images.values())
+
+        return sources
+
+    def _count_media_cache_lookups(self, page):
+        for media in list(page.attachments.values()) + list(page.images.values()):
+            if media.from_cache is None:
+                continue
+
+            if media.from_cache:
+                self.media_cache_hits += 1
+            else:
+                self.media_cache_misses += 1
+
+    def _is_cached(self, path, response_paths):
+        """Check if page was parsed on the previous run and its sources haven't changed since"""
+        if self.page_cache is None or path not in self.page_cache:
+            return False
+
+        if self.manifest.document_changed(path, response_paths):
+            return False
+
+        self.manifest.keep_document(path)
+
+        return True
+
+    def _parse_pages(self, paths, response_paths):
+        """Parse pages at paths with corresponding response paths, yielding them in order
+
+        In incremental mode, pages parsed on the previous run are reused if their sources have not
+        changed.
+        """
+        cached = [self._is_cached(path, page_response_paths or [])
+                  for path, page_response_paths in zip(paths, response_paths)]
+
+        # parse everything not in the cache
+        new_pages = self._parse_new_pages(
+            [path for path, is_cached in zip(paths, cached) if not is_cached],
+            [page_response_paths for page_response_paths, is_cached in zip(response_paths, cached)
+             if not is_cached])
+
+        for path, is_cached in zip(paths, cached):
+            if is_cached:
+                # load only when needed so that cached pages aren't all held in memory
+                self.logger.debug("reusing %s parsed on previous run", path)
+                self.stats.count("pages_reused")
+                yield self.page_cache[path]
+                continue
+
+            page = next(new_pages)
+
+            # add statistics recorded while parsing, which aren't kept with the page
+            self.stats.merge(page.stats)
+            page.stats = None
+            self.stats.count("pages_parsed")
+
+            self._count_media_cache_lookups(page)
+
+            if self.page_cache is not None:
+                # store for the next run
+                self.page_cache[page.path] = page
+                self.manifest.add_document(page.path, page.response_paths, self._page_sources(page))
+
+            yield page
+
+        # shut down workers
+        new_pages.close()
+
+    def _parse_new_pages(self, paths, response_paths):
+        """Parse pages at paths with corresponding response paths, yielding them in order"""
+        parse = partial(_parse_page, archive_dir=self.archive_dir, timezone=self.timezone,
+                        parser=self.parser, media_cache_path=self.media_cache_filepath)
+
+        if self.jobs is None or self.jobs <= 1:
+            # parse in this process
+            yield from map(parse, paths, response_paths)
+            return
+
+        # give each worker a few chunks of pages at a time to reduce overhead
+        chunksize = max(1, min(self.MAX_CHUNK_SIZE, len(paths) // (self.jobs * 4)))
+        # submit a limited number of pages at a time so that parsed pages waiting to be consumed
+        # don't accumulate in memory
+        batch_size = self.jobs * chunksize * 8
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            for start in range(0, len(paths), batch_size):
+                # results are returned in submission order
+                yield from executor.map(parse, paths[start:start + batch_size],
+                                        response_paths[start:start + batch_size],
+                                        chunksize=chunksize)
+
+    def read(self):
+        """Parse all pages, keeping originals in pages and orphaned_pages"""
+        with collecting(self.stats):
+            self._make_archive_dir()
+            self._read_originals()
+
+    def _read_originals(self):
+        for page, original_path, orphan in self._read_pages():
+            if original_path != page.path:
+                # duplicate
+                continue
+
+            if orphan:
+                self.orphaned_pages.append(page)
+            else:
+                self.pages.append(page)
+
+    def _read_pages(self):
+        """Parse pages, yielding each with the path of its original and whether it is an orphan
+
+        Pages on the contents pages are yielded in chronological order, then orphaned pages.
+        """
+        self.file_index = FileIndex(self.root_dir, self.file_index_filepath)
+        self._index_files()
+
+        if not self.incremental:
+            yield from self._read()
+            return
+
+        settings = {"parser": self.parser, "timezone": str(self.timezone),
+                    "version": self.PAGE_CACHE_VERSION}
+        self.manifest = SourceManifest(self.manifest_filepath, settings=settings)
+        self.page_cache = shelve.open(self.page_cache_filepath)
+
+        try:
+            yield from self._read()
+
+            # forget pages whose sources have disappeared
+            for path in list(self.page_cache.keys()):
+                if path not in self.manifest.documents:
+                    del self.page_cache[path]
+        finally:
+            self.page_cache.close()
+            self.page_cache = None
+
+    def _read(self):
+        # running list of parsed urls
+        parsed_urls = set()
+        extra_pages = []
+
+        # dict of page dicts
+        pages_info = {}
+
+        root_contents_pages = self.file_index.match(self.root_contents_wildcard)
+        total_contents_pages = len(root_contents_pages)
+
+        contents_links = self._scan_contents_pages(
+            [os.path.join(self.root_dir, path) for path in root_contents_pages])
+
+        for j, (contents_page, page_links) in enumerate(zip(root_contents_pages, contents_links),
+                                                        start=1):
+            self.logger.info("Read contents page %i/%i (%s)", j, total_contents_pages,
+                             contents_page)
+
+            current_page_key = ()
+
+            for page_link in page_links:
+                if page_link.is_response:
+                    # link is a response
+                    if not current_page_key:
+                        # this is a response without a parent - ignore
+                        self.logger.warning("Ignoring orphaned response at %s", page_link.href)
+                    elif page_link.href not in pages_info[current_page_key]["response_urls"]:
+                        pages_info[current_page_key]["response_urls"][page_link.href] = None
+                        
+                        self.logger.debug("Found response to page '%s' (p%i)",
+                                         pages_info[current_page_key]["title"],
+                                         pages_info[current_page_key]["number"])
                 else:
-                    self.pages.append(page)
+                    # page dict key
+                    current_page_key = tuple((page_link.title, page_link.number))
+
+                    if current_page_key not in pages_info:
+                        # this page hasn't been seen before
+                        pages_info[current_page_key] = {"title": page_link.title,
+                                                        "number": page_link.number,
+                                                        "url": page_link.href,
+                                                        # in contents page order, so the
+                                                        # archive is the same on every run
+                                                        "response_urls": {}}
+
+                        self.logger.debug("Found page '%s' (p%i)", page_link.title,
+                                         page_link.number)
+
+                # store decoded URL
+                parsed_urls.add(urllib.parse.unquote(page_link.href))
+
+        # parse remaining pages not on the contents - this is necessary because there are
+        # duplicate pages with different URLs... which is stupid :-/
+        for page_link in self._documents_relative_to_contents:
+            if page_link in parsed_urls:
+                # skip
+                continue
+            
+            extra_pages.append(page_link)                
+            parsed_urls.add(page_link)
 
-                    original = page
-                
-                # map target path
-                self.logger.debug("mapping %s to %s" % (page.path, original))
-                self.page_paths[page.path] = original
+        # total number of pages found
+        total = len(pages_info)
+        total_extra = len(extra_pages)
 
-                # add response paths
-                for response_page in page.response_pages:
-                    if response_page.path in self.page_paths:
-                        raise ValueError("a response has been found (%s) with the same path as a page" % response_page.path)
+        # pages in chronological order
+        page_infos = list(reversed(list(pages_info.values())))
 
-                    # map links in responses to original posts
-                    self.page_paths[response_page.path] = original
+        # convert paths to absolute, local links
+        main_paths = [self._absolute_path(page_info["url"]) for page_info in page_infos]
+        main_response_paths = [[self._absolute_path(response_path)
+                                for response_path in page_info["response_urls"]]
+                               for page_info in page_infos]
 
-            # loop over extra pages and find their duplicates
-            for count, path in enumerate(extra_pages, 1):
-                # convert path to full path
-                path = os.path.join(self.root_dir, path)
+        # parse main documents
+        main_pages = self._parse_pages(main_paths, main_response_paths)
+        progress = Progress(self.logger, "read", total)
 
-                self.logger.info("%i / %i reading extra page %s", count, total_extra, path)
+        for count, (page_info, page) in enumerate(zip(page_infos, main_pages), 1):
+            self.logger.debug("%i / %i read %s (p%s) with %i response(s)",
+                              count, total, page_info["title"], page_info["number"],
+                              len(page_info["response_urls"]))
 
-                # parse extra page
-                page = LotusPage(path, self.archive_dir, timezone=self.timezone, parser=self.parser)
+            self.logger.debug("parsed %s", page)
+            progress.update()
 
-                self.logger.info("parsed %s" % page)
+            original_path = self._find_original(page)
 
-                if page in self.pages:
-                    # this is a duplicate
-                    # get first occurrance
-                    original = self.pages[self.pages.index(page)]
+            if original_path == page.path:
+                original = self._page_target(page)
+            else:
+                original = self.page_paths[original_path]
 
-                    self.logger.warning("path %s is a duplicate of %s" % (page.path, original.path))
-                else:
-                    # this is not a duplicate but is not on the contents page...
-                    self.logger.info("adding page '%s' not found on contents page "
-                                    "(no responses will be added)", page)
-                    
-                    self.orphaned_pages.append(page)
+            # map target path
+            self.logger.debug("mapping %s to %s", page.path, original)
+            self.page_paths[page.path] = original
+
+            # add response paths
+            for response_page in page.response_pages:
+                if response_page.path in self.page_paths:
+                    raise ValueError("a response has been found (%s) with the same path as a page" % response_page.path)
+
+                # map links in responses to original posts
+                self.page_paths[response_page.path] = original
+
+            yield page, original_path, False
+
+        # convert extra paths to full paths
+        extra_paths = [os.path.join(os.path.abspath(self.root_dir), path) for path in extra_pages]
+
+        # parse extra pages (these have no responses)
+        extra_parsed_pages = self._parse_pages(extra_paths, [None] * total_extra)
+
+        progress = Progress(self.logger, "read", total_extra, unit="extra pages")
+
+        # loop over extra pages and find their duplicates
+        for count, (path, page) in enumerate(zip(extra_paths, extra_parsed_pages), 1):
+            self.logger.debug("%i / %i read extra page %s", count, total_extra, path)
+
+            self.logger.debug("parsed %s", page)
+            progress.update()
 
-                    original = page
-                
-                # map target path
-                self.logger.debug("mapping %s to %s" % (page.path, original))
-                self.page_paths[page.path] = original
+            original_path = self._find_original(page)
 
-    def dump(self):
-        self.read()
+            if original_path == page.path:
+                # this is not a duplicate but is not on the contents page...
+                self.logger.debug("added page '%s' not found on contents page "
+                                  "(no responses will be added)", page)
+                original = self._page_target(page)
+            else:
+                original = self.page_paths[original_path]
 
-        self.logger.debug("Page paths:")
-        self.logger.debug(self.page_paths)
+            # map target path
+            self.logger.debug("mapping %s to %s", page.path, original)
+            self.page_paths[page.path] = original
 
+            yield page, original_path, True
+
+    def _archive_media(self, media_files):
+        """Archive media files, yielding the archive method used and bytes copied for each"""
+        archive = partial(LotusMedia.archive, strategy=self.archive_strategy)
+
+        if self.jobs is None or self.jobs <= 1:
+            yield from map(archive, media_files)
+            return
+
+        # archiving is limited by I/O, so threads are enough
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            yield from executor.map(archive, media_files)
+
+    def _pages_to_archive(self):
+        """Original pages to archive, with whether each is an orphan
+
+        Pages come first then orphans so the orphans don't disrupt page number order.
+        """
+        if not self.streaming:
+            self._read_originals()
+
+            for page in self.pages:
+                yield page, False
+
+            for page in self.orphaned_pages:
+                yield page, True
+
+            return
+
+        for page, original_path, orphan in self._read_pages():
+            if original_path == page.path:
+                yield page, orphan
+
+    def dump(self, keep_pages=False):
+        """Parse all pages and archive them, with their media, authors and categories
+
+        If keep_pages is True, the archived pages are also kept in memory in page_store, which is
+        left open.
+        """
+        with collecting(self.stats):
+            with self.stats.timer("total"):
+                self._dump(keep_pages)
+
+        self.stats.log(self.logger)
+
+        if self.stats_file is not None:
+            self.stats.write(self.stats_file, "dump")
+            self.logger.info("wrote statistics to %s", self.stats_file)
+
+    def _dump(self, keep_pages):
         # running list of media file hashes and objects
         media_files = {}
 
+        # authors and categories of pages on the contents pages
+        authors = set()
+        categories = set()
+
+        # hashes of archived pages, archive paths of media files on each page and pages with links
+        # to pages not yet parsed
+        page_hashes = set()
+        page_media_paths = {}
+        unresolved_urls = None
+
+        # metadata of archived pages, so the WordPress writer doesn't have to parse every page to
+        # assign post ids
+        page_index = PageIndex(self.page_index_filepath)
+
         # running counts of pages, etc.
         npages = 0
+        norphans = 0
         nimages = 0
         nattachments = 0
         nurls = 0
         nauthors = 0
         ncategories = 0
+        nsanitised = 0
 
-        # loop over pages first then orphans second so the orphans don't disrupt page number order
-        for page in self.pages + self.orphaned_pages:
-            npages += 1
-            self.logger.debug("archiving %s" % page)
-
-            # map page paths to objects
-            for unique_hash, path in page.urls.items():
-                nurls += 1
-                # replace path with target, deduplicated object
-                page.urls[unique_hash] = self.page_paths[path]
-
-            # map attachment paths to objects
-            for unique_hash, attachment in page.attachments.items():
-                nattachments += 1
-                if unique_hash in media_files:
-                    # duplicate; update object
-                    self.logger.info("attachment %s on %s is duplicate of %s" % (attachment, page, media_files[unique_hash]))
-                    page.attachments[unique_hash] = media_files[unique_hash]
-                else:
-                    # add attachment to list
-                    media_files[unique_hash] = attachment
-            
-            # map image paths to objects
-            for unique_hash, image in page.images.items():
-                nimages += 1
-                if unique_hash in media_files:
-                    # duplicate; update object
-                    self.logger.info("image %s on %s is duplicate of %s" % (image, page, media_files[unique_hash]))
-                    page.images[unique_hash] = media_files[unique_hash]
-                else:
-                    # add image to list
-                    media_files[unique_hash] = image
+        self._make_archive_dir()
 
-            # archive page
-            page.archive()
+        if self.archive_pages:
+            self.page_store = open_page_store(self.page_archive, self.archive_dir)
+        else:
+            self.page_store = None
 
-        # archive deduplicated media files
-        for media_file in media_files.values():
-            media_file.archive()
-        
-        # archive authors
-        authors = etree.Element("authors")
-        for author in self.authors:
-            nauthors += 1
-            etree.SubElement(authors, "author").text = etree.CDATA(author)
-        tree = etree.ElementTree(authors)
-        tree.write(self.author_archive_filepath, encoding="utf-8", xml_declaration=True)
-
-        # archive categories
-        categories = etree.Element("categories")
-        for category in self.categories:
-            ncategories += 1
-            etree.SubElement(categories, "category").text = etree.CDATA(category)
-        tree = etree.ElementTree(categories)
-        tree.write(self.category_archive_filepath, encoding="utf-8", xml_declaration=True)
+        if keep_pages or not self.archive_pages:
+            # pages can then be read back without being serialised and parsed again
+            self.page_store = MemoryPageStore(self.page_store)
+
+        if self.streaming:
+            # pages are released once archived, so keep the maps needed to resolve links between
+            # them on disk
+            self.page_paths = shelve.open(self.page_paths_filepath, flag="n")
+            unresolved_urls = shelve.open(self.unresolved_urls_filepath, flag="n")
+
+        try:
+            for page, orphan in self._pages_to_archive():
+                npages += 1
+
+                for parsed_page in [page] + page.response_pages:
+                    if parsed_page.removed_characters:
+                        nsanitised += 1
+                self.logger.debug("archiving %s", page)
+
+                if orphan:
+                    norphans += 1
+                else:
+                    for author_page in [page] + page.response_pages:
+                        authors.update(author_page.authors)
+                        categories.update(author_page.categories)
+
+                url_paths = list(page.urls.items())
+
+                # map page paths to archive paths
+                for unique_hash, path in url_paths:
+                    nurls += 1
+                    # replace path with target, deduplicated page
+                    page.urls[unique_hash] = self._original_archive_path(path)
+
+                    if page.urls[unique_hash] is None and not self.streaming:
+                        self.logger.warning("link %s on %s is to a page that wasn't found (%s)",
+                                            unique_hash, page, path)
+
+                if self.streaming and None in page.urls.values():
+                    # some linked pages may not have been parsed yet
+                    unresolved_urls[page.unique_hash] = url_paths
+
+                # map attachment paths to objects
+                for unique_hash, attachment in page.attachments.items():
+                    nattachments += 1
+                    if unique_hash in media_files:
+                        # duplicate; update object
+                        self.logger.debug("attachment %s on %s is duplicate of %s", attachment, page, media_files[unique_hash])
+                        page.attachments[unique_hash] = media_files[unique_hash]
+                    else:
+                        # add attachment to list
+                        media_files[unique_hash] = attachment
+
+                # map image paths to objects
+                for unique_hash, image in page.images.items():
+                    nimages += 1
+                    if unique_hash in media_files:
+                        # duplicate; update object
+                        self.logger.debug("image %s on %s is duplicate of %s", image, page, media_files[unique_hash])
+                        page.images[unique_hash] = media_files[unique_hash]
+                    else:
+                        # add image to list
+                        media_files[unique_hash] = image
+
+                if self.incremental:
+                    page_hashes.add(page.unique_hash)
+                    page_media_paths[page.archive_path] = [
+                        media.archive_path for media in list(page.attachments.values())
+                                                        + list(page.images.values())]
+
+                # archive page
+                with self.stats.timer("page.archive"):
+                    page.archive(self.page_store)
+
+                page_index.add(page.unique_hash, page.index_entry())
+
+            if self.streaming:
+                with self.stats.timer("links.resolve"):
+                    self._resolve_urls(unresolved_urls, page_index)
+
+            # archive deduplicated media files
+            media_methods = Counter()
+            nbytes_copied = 0
+            progress = Progress(self.logger, "archived", len(media_files), unit="media files")
+
+            with self.stats.timer("media.archive"):
+                for method, ncopied in self._archive_media(media_files.values()):
+                    media_methods[method] += 1
+                    nbytes_copied += ncopied
+                    progress.update()
+
+            self.stats.add_bytes("media_copied", nbytes_copied)
+
+            # archive authors, sorted so they are given the same ids on every run
+            author_elements = etree.Element("authors")
+            for author in sorted(authors):
+                nauthors += 1
+                etree.SubElement(author_elements, "author").text = etree.CDATA(author)
+            tree = etree.ElementTree(author_elements)
+            tree.write(self.author_archive_filepath, encoding="utf-8", xml_declaration=True)
+
+            # archive categories, sorted so they are given the same term ids on every run
+            category_elements = etree.Element("categories")
+            for category in sorted(categories):
+                ncategories += 1
+                etree.SubElement(category_elements, "category").text = etree.CDATA(category)
+            tree = etree.ElementTree(category_elements)
+            tree.write(self.category_archive_filepath, encoding="utf-8", xml_declaration=True)
+
+            page_index.save()
+
+            if self.incremental:
+                with self.stats.timer("incremental.finish"):
+                    self._finish_incremental(page_hashes, page_media_paths, media_files)
+        finally:
+            if not keep_pages:
+                self.page_store.close()
+                self.page_store = None
+
+            if self.streaming:
+                self.page_paths.close()
+                unresolved_urls.close()
+                self._remove_shelf(self.page_paths_filepath)
+                self._remove_shelf(self.unresolved_urls_filepath)
 
         self.logger.info("archived:")
-        self.logger.info("\t%i pages (%i orphans)", npages, len(self.orphaned_pages))
+        self.logger.info("\t%i pages (%i orphans)", npages, norphans)
         self.logger.info("\t%i media items (%i images, %i attachments)", nimages + nattachments, nimages, nattachments)
+        for method, count in sorted(media_methods.items()):
+            self.logger.info("\t\t%i media files archived by %s", count, method)
+        self.logger.info("\t\t%i bytes of media copied (strategy: %s)", nbytes_copied,
+                         self.archive_strategy)
         self.logger.info("\t%i internal URLs", nurls)
         self.logger.info("\t%i authors", nauthors)
         self.logger.info("\t%i categories", ncategories)
+        self.logger.info("\t%i pages or responses with characters not allowed in XML removed",
+                         nsanitised)
+
+        self.stats.counts.update({"pages": npages, "orphans": norphans, "images": nimages,
+                                  "attachments": nattachments, "media_files": len(media_files),
+                                  "urls": nurls, "authors": nauthors, "categories": ncategories,
+                                  "sanitised": nsanitised})
+
+        MediaSniffer.release(self.media_cache_filepath)
+
+        if self.media_cache:
+            media_cache = MediaCache.shared(self.media_cache_filepath)
+            nevicted = media_cache.evict()
+            media_cache.close()
+
+            self.logger.info("media cache: %i hits, %i misses, %i stale entries evicted",
+                             self.media_cache_hits, self.media_cache_misses, nevicted)
+
+            self.stats.counts.update({"media_cache_hits": self.media_cache_hits,
+                                      "media_cache_misses": self.media_cache_misses})
+
+    def convert(self, writer):
+        """Archive logbook and generate its WordPress import file with writer in one pass
+
+        Parsed pages are handed to the writer as XML elements in memory, instead of being archived
+        and parsed again by the writer. Pages are only also archived if archive_pages is set, but
+        media, authors and categories are always archived as the writer uses them. Create the
+        writer without debug_log_file or quiet for it to log where the builder does.
+        """
+        if os.path.abspath(writer.archive_dir) != os.path.abspath(self.archive_dir):
+            raise ValueError("writer must use the builder's archive directory")
+
+        self.dump(keep_pages=True)
+
+        try:
+            writer.generate(self.page_store)
+        finally:
+            self.page_store.close()
+            self.page_store = None
+
+    def _resolve_urls(self, unresolved_urls, page_index):
+        """Rewrite links in archived pages that linked to pages parsed after them"""
+        self.logger.info("resolving links in %i archived pages", len(unresolved_urls))
+
+        for page_hash, url_paths in unresolved_urls.items():
+            page = self.page_store.load(page_hash)
+            urls = page.find("urls")
+
+            for url in list(urls):
+                urls.remove(url)
+
+            for unique_hash, path in url_paths:
+                target = self._original_archive_path(path)
+
+                if target is None:
+                    self.logger.warning("link %s on %s is to a page that wasn't found (%s)",
+                                        unique_hash, page_hash, path)
+                    continue
+
+                etree.SubElement(urls, "url", path=target).text = unique_hash
+
+            self.page_store.write_element(page_hash, page)
+            page_index.set_urls(page_hash, [url.get("path") for url in urls])
+
+    @staticmethod
+    def _remove_shelf(path):
+        # the dbm backend may add an extension to the path
+        for filename in glob.glob(glob.escape(path) + "*"):
+            os.remove(filename)
+
+    def _finish_incremental(self, page_hashes, page_media_paths, media_files):
+        """Record archive files produced on this run and remove those no longer produced"""
+        for path in self.manifest.documents:
+            archive_path = self._original_archive_path(path)
+
+            outputs = [archive_path]
+            outputs.extend(page_media_paths.get(archive_path, []))
+
+            self.manifest.add_outputs(path, outputs)
+
+        self.manifest.save()
+
+        nremoved = 0
+
+        for page_hash in self.page_store.hashes():
+            if page_hash not in page_hashes:
+                self.logger.info("removing page %s as its source no longer exists", page_hash)
+                self.page_store.remove(page_hash)
+                nremoved += 1
+
+        current_paths = set(os.path.normpath(media.archive_path) for media in media_files.values())
+
+        for entry in os.scandir(self.media_archive_dir):
+            if entry.is_file() and os.path.normpath(entry.path) not in current_paths:
+                self.logger.info("removing %s as its source no longer exists", entry.path)
+                os.remove(entry.path)
+                nremoved += 1
+
+        self.logger.info("removed %i archived files without sources", nremoved)
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from binaryornot.helpers import is_binary_string
+import magic
+
+from .cache import MediaCache
+from .stats import current as current_stats
+
+# size of buffers read from files; the first is used to detect the MIME type
+BUFFER_SIZE = 1048576
+
+# number of bytes at the start of a file checked for binary content, as binaryornot does
+BINARY_CHECK_SIZE = 1024
+
+MediaInfo = collections.namedtuple("MediaInfo", ("file_hash", "mime_type"))
+
+# sniffers, keyed by process and cache path, as neither threads nor connections survive forks
+_SHARED_SNIFFERS = {}
+
+
+def is_binary_buffer(data):
+    """Check if data read from the start of a file looks binary"""
+    return is_binary_string(data[:BINARY_CHECK_SIZE])
+
+def mime_type_buffer(data):
+    """MIME type of data read from the start of a file"""
+    return magic.from_buffer(data, mime=True)
+
+
+class MediaSniffer:
+    """Hashes and detects the MIME type of media files, reading each file once
+
+    The MIME type is detected from the first buffer read for hashing. Results are memoised by the
+    device, inode, size and modification time of the file, with whether they were found in the
+    cache, and if a cache path is specified, are also looked up in and saved to a MediaCache.
+    """
+
+    def __init__(self, cache_path=None, jobs=None):
+        self.cache_path = cache_path
+        # number of files to sniff at once (None for ThreadPoolExecutor default)
+        self.jobs = jobs
+
+        self._results = {}
+        self._executor = None
+
+    @classmethod
+    def shared(cls, cache_path=None):
+        """Get sniffer for this process using the cache at the specified path"""
+        key = (os.getpid(), cache_path)
+
+        if key not in _SHARED_SNIFFERS:
+            _SHARED_SNIFFERS[key] = cls(cache_path)
+
+        return _SHARED_SNIFFERS[key]
+
+    @classmethod
+    def release(cls, cache_path=None):
+        """Forget the sniffer for this process using the cache at the specified path, e.g. at the
+        end of a dump, so the next dump reports whether files are found in the cache afresh"""
+        sniffer = _SHARED_SNIFFERS.pop((os.getpid(), cache_path), None)
+
+        if sniffer is not None and sniffer._executor is not None:
+            sniffer._executor.shutdown()
+
+    def sniff(self, path):
+        """Get hash and MIME type of the file at path
+
+        Returns the MediaInfo and whether it was found in the cache rather than read from the file,
+        the first time the file was sniffed by this sniffer.
+        """
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        result = self._results.get(key)
+
+        if result is not None:
+            return result
+
+        cache = None
+
+        if self.cache_path is not None:
+            cache = MediaCache.shared(self.cache_path)
+            cached = cache.get(stat)
+
+            if cached is not None:
+                result = self._results[key] = (MediaInfo(*cached), True)
+                return result
+
+        info = self._read(path)
+        result = self._results[key] = (info, False)
+
+        if cache is not None:
+            cache.put(stat, path, info.file_hash, info.mime_type)
+
+        return result
+
+    def sniff_many(self, paths):
+        """Sniff files at paths concurrently, returning results in the same order"""
+        if len(paths) < 2:
+            return [self.sniff(path) for path in paths]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+        return list(self._executor.map(self.sniff, paths))
+
+    @staticmethod
+    def _read(path):
+        md5 = hashlib.md5()
+        mime_type = None
+        stats = current_stats()
+
+        with open(path, 'rb') as obj:
+            while True:
+                data = obj.read(BUFFER_SIZE)
+
+                if mime_type is None:
+                    with stats.timer("media.mime"):
+                        mime_type = mime_type_buffer(data)
+
+                if not data:
+                    # end of file
+                    break
+
+                with stats.timer("media.hash"):
+                    md5.update(data)
+
+                stats.add_bytes("media_hashed", len(data))
+
+        return MediaInfo(md5.hexdigest(), mime_type)
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+from collections import Counter
+
+# seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+# statistics that timings and counts are recorded to in this process; pages are parsed with their own
+# statistics, which are sent back with them from worker processes
+_active = None
+# statistics recorded when nothing is collecting them
+_discarded = None
+
+
+def current():
+    """Statistics that timings and counts are recorded to in this process"""
+    global _discarded
+
+    if _active is not None:
+        return _active
+
+    if _discarded is None:
+        _discarded = Stats()
+
+    return _discarded
+
+@contextlib.contextmanager
+def collecting(stats=None):
+    """Record timings and counts in this process to stats, or to new statistics if not specified"""
+    global _active
+
+    if stats is None:
+        stats = Stats()
+
+    previous = _active
+    _active = stats
+
+    try:
+        yield stats
+    finally:
+        _active = previous
+
+
+class Stats:
+    """Time spent in, and counts and bytes processed by, the stages of a run
+
+    Stages can be nested, e.g. hashing media is part of extracting page content, so their times
+    don't add up to the total. Timings can be recorded from several threads at once.
+    """
+
+    def __init__(self):
+        # seconds spent in and number of calls to each stage
+        self.seconds = Counter()
+        self.calls = Counter()
+        # counts of things processed and bytes read or written
+        self.counts = Counter()
+        self.bytes = Counter()
+
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks can't be sent to other processes
+        state = dict(self.__dict__)
+        del state["_lock"]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time the enclosed code as part of stage"""
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self, name, number=1):
+        with self._lock:
+            self.counts[name] += number
+
+    def add_bytes(self, name, nbytes):
+        with self._lock:
+            self.bytes[name] += nbytes
+
+    def merge(self, other):
+        """Add timings and counts from other statistics"""
+        with self._lock:
+            self.seconds.update(other.seconds)
+            self.calls.update(other.calls)
+            self.counts.update(other.counts)
+            self.bytes.update(other.bytes)
+
+    def as_dict(self):
+        return {"seconds": dict(sorted(self.seconds.items())),
+                "calls": dict(sorted(self.calls.items())),
+                "counts": dict(sorted(self.counts.items())),
+                "bytes": dict(sorted(self.bytes.items()))}
+
+    def prometheus(self, command):
+        """Statistics in the Prometheus text format, with the specified command label"""
+        metrics = (("lotus_stage_seconds_total", "Time spent in each stage.", "stage",
+                    self.seconds),
+                   ("lotus_stage_calls_total", "Number of times each stage was run.", "stage",
+                    self.calls),
+                   ("lotus_processed_total", "Number of things processed.", "name", self.counts),
+                   ("lotus_processed_bytes_total", "Number of bytes read or written.", "name",
+                    self.bytes))
+
+        lines = []
+
+        for metric, description, label, values in metrics:
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s counter" % metric)
+
+            for name, value in sorted(values.items()):
+                lines.append('%s{command="%s",%s="%s"} %s' % (metric, command, label, name,
+                                                               repr(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, command):
+        """Write statistics to path, in the Prometheus text format if it ends with .prom and as JSON
+        otherwise
+
+        The file is replaced atomically so that it can be read by e.g. node_exporter's textfile
+        collector while it is written.
+        """
+        if path.endswith(".prom"):
+            data = self.prometheus(command)
+        else:
+            data = json.dumps({"command": command, **self.as_dict()}, indent=2) + "\n"
+
+        temporary_path = "%s.%i.tmp" % (path, os.getpid())
+
+        with open(temporary_path, "w") as obj:
+            obj.write(data)
+
+        os.replace(temporary_path, path)
+
+    def log(self, logger):
+        """Log time spent in each stage, longest first"""
+        logger.info("timings:")
+
+        for stage, seconds in self.seconds.most_common():
+            logger.info("\t%s: %.2f s (%i calls)", stage, seconds, self.calls[stage])
+
+        for name, nbytes in sorted(self.bytes.items()):
+            logger.info("\t%s: %i bytes", name, nbytes)
+
+
+class Progress:
+    """Logs the throughput and estimated time remaining of a stage at intervals"""
+
+    def __init__(self, logger, description, total, unit="pages", interval=PROGRESS_INTERVAL):
+        self.logger = logger
+        self.description = description
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+
+        self.done = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def update(self, number=1):
+        self.done += number
+        now = time.perf_counter()
+
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            self._log(now - self._start)
+
+    def _log(self, elapsed):
+        rate = self.done / elapsed if elapsed > 0 else 0
+
+        if rate > 0:
+            remaining = datetime.timedelta(seconds=round((self.total - self.done) / rate))
+        else:
+            remaining = "unknown"
+
+        # shown in quiet mode
+        self.logger.info("%s %i/%i %s (%.1f %s/s, %s remaining)", self.description, self.done,
+                         self.total, self.unit, rate, self.unit, remaining,
+                         extra={"progress": True})
@@ -0,0 +1,237 @@
+import os
+import json
+import sqlite3
+from lxml import etree
+
+from .tools import write_if_changed
+from .discovery import FileIndex, archive_file_kind
+from .stats import current as current_stats
+
+# ways of storing archived pages
+PAGE_ARCHIVES = ("directory", "packed")
+
+
+def serialize_page(page):
+    """Archived XML document of page element"""
+    data = etree.tostring(etree.ElementTree(page), encoding="UTF-8", xml_declaration=True)
+    current_stats().add_bytes("page_xml", len(data))
+
+    return data
+
+def parse_page(data):
+    """Page element of archived XML document"""
+    current_stats().add_bytes("page_xml_read", len(data))
+
+    # keep CDATA sections so that pages written back are identical to those written directly
+    return etree.fromstring(data, etree.XMLParser(strip_cdata=False))
+
+
+def open_page_store(page_archive, archive_dir):
+    """Open the store of pages archived in archive_dir in the specified way"""
+    if page_archive == "directory":
+        return DirectoryPageStore(os.path.join(archive_dir, "pages"),
+                                  os.path.join(archive_dir, "meta", "page-files.json"))
+    elif page_archive == "packed":
+        return PackedPageStore(os.path.join(archive_dir, "pages.sqlite"))
+
+    raise ValueError("page archive must be one of %s" % ", ".join(PAGE_ARCHIVES))
+
+
+class PageStore:
+    """Store of archived pages, keyed by their hashes"""
+
+    def write_element(self, page_hash, page):
+        """Write page element unless an identical page is already stored, returning True if it was
+        written"""
+        return self.write(page_hash, serialize_page(page))
+
+    def load(self, page_hash):
+        """Page element of stored page"""
+        return parse_page(self.read(page_hash))
+
+
+class DirectoryPageStore(PageStore):
+    """Archived pages stored as XML files named by their hashes"""
+
+    def __init__(self, directory, index_path=None):
+        self.directory = directory
+        self.index = FileIndex(directory, index_path, recursive=False, classify=archive_file_kind)
+
+    def path(self, page_hash):
+        return os.path.join(self.directory, page_hash + ".xml")
+
+    def write(self, page_hash, data):
+        """Write page unless an identical one is already stored, returning True if it was written"""
+        return write_if_changed(self.path(page_hash), data)
+
+    def read(self, page_hash):
+        with open(self.path(page_hash), "rb") as obj:
+            return obj.read()
+
+    def remove(self, page_hash):
+        os.remove(self.path(page_hash))
+
+    def hashes(self):
+        """Hashes of stored pages, sorted"""
+        # reuse index from the previous listing if no pages have been added or removed since
+        self.index.update()
+
+        return [os.path.splitext(path)[0] for path in self.index.paths("page")]
+
+    def close(self):
+        # save index so the next reader doesn't need to list the directory again
+        self.index.update()
+        self.index.save()
+
+
+class PackedPageStore(PageStore):
+    """Archived pages stored in a single SQLite database, keyed by their hashes
+
+    This avoids creating a file per page, which is slow for large logbooks and makes the archive
+    slow to copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pages (hash TEXT PRIMARY KEY, "
+                                "data BLOB)")
+        self.connection.commit()
+
+    def write(self, page_hash, data):
+        """Write page unless an identical one is already stored, returning True if it was written"""
+        row = self.connection.execute("SELECT data FROM pages WHERE hash = ?",
+                                      (page_hash,)).fetchone()
+
+        if row is not None and row[0] == data:
+            return False
+
+        self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?)", (page_hash, data))
+
+        return True
+
+    def read(self, page_hash):
+        row = self.connection.execute("SELECT data FROM pages WHERE hash = ?",
+                                      (page_hash,)).fetchone()
+
+        if row is None:
+            raise KeyError(page_hash)
+
+        return row[0]
+
+    def remove(self, page_hash):
+        self.connection.execute("DELETE FROM pages WHERE hash = ?", (page_hash,))
+
+    def hashes(self):
+        """Hashes of stored pages, sorted"""
+        return [row[0] for row in self.connection.execute("SELECT hash FROM pages ORDER BY hash")]
+
+    def close(self):
+        # pages are written in a single transaction
+        self.connection.commit()
+        self.connection.close()
+
+
+class MemoryPageStore(PageStore):
+    """Page elements held in memory, optionally also archived in another store
+
+    Pages written to this store can be read back without being serialised and parsed again. Pages
+    only in the other store are read from it.
+    """
+
+    def __init__(self, backing_store=None):
+        self.backing_store = backing_store
+        self.pages = {}
+
+    def write_element(self, page_hash, page):
+        self.pages[page_hash] = page
+
+        if self.backing_store is not None:
+            return self.backing_store.write_element(page_hash, page)
+
+        return True
+
+    def write(self, page_hash, data):
+        return self.write_element(page_hash, parse_page(data))
+
+    def read(self, page_hash):
+        return serialize_page(self.load(page_hash))
+
+    def load(self, page_hash):
+        if page_hash in self.pages or self.backing_store is None:
+            return self.pages[page_hash]
+
+        return self.backing_store.load(page_hash)
+
+    def remove(self, page_hash):
+        self.pages.pop(page_hash, None)
+
+        if self.backing_store is not None:
+            self.backing_store.remove(page_hash)
+
+    def hashes(self):
+        """Hashes of stored pages, sorted"""
+        hashes = set(self.pages)
+
+        if self.backing_store is not None:
+            hashes.update(self.backing_store.hashes())
+
+        return sorted(hashes)
+
+    def close(self):
+        # pages are kept so they can still be read
+        if self.backing_store is not None:
+            self.backing_store.close()
+
+
+def archived_page_hash(archive_path):
+    """Hash of page archived at path"""
+    return os.path.splitext(os.path.basename(archive_path))[0]
+
+
+class PageIndex:
+    """Metadata of archived pages, so they can be listed without parsing each of them
+
+    Each entry has the page's number, title, creation time, authors, categories and the hashes of
+    its media and of the pages it links to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # page hashes -> metadata
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read index written to path, or return None if there isn't one"""
+        if not os.path.isfile(path):
+            return None
+
+        index = cls(path)
+
+        with open(path, "r") as obj:
+            index.entries = json.load(obj)
+
+        return index
+
+    def save(self):
+        # replaced atomically, so it's never read half written
+        temporary_path = "%s.%i.tmp" % (self.path, os.getpid())
+
+        with open(temporary_path, "w") as obj:
+            json.dump(self.entries, obj, separators=(",", ":"), sort_keys=True)
+
+        os.replace(temporary_path, self.path)
+
+    def add(self, page_hash, entry):
+        self.entries[page_hash] = entry
+
+    def set_urls(self, page_hash, archive_paths):
+        """Set the pages linked to from page, by their archive paths"""
+        self.entries[page_hash]["urls"] = sorted(set(archived_page_hash(path)
+                                                     for path in archive_paths))
+
+    def hashes(self):
+        """Hashes of indexed pages, sorted"""
+        return sorted(self.entries)
@@ -0,0 +1,287 @@
+import os
+import random
+import logging
+import datetime
+import urllib.parse
+
+LOGGER = logging.getLogger("lotus")
+
+# contents page, as saved by scripts/scrape.sh, and a wildcard matching it
+CONTENTS_PAGE = "By Author?OpenView&Start=1&Count=5000"
+CONTENTS_WILDCARD = CONTENTS_PAGE + "*"
+
+# database directory, and the views documents are found under; documents are linked from the
+# contents page under the first view, and some are also found under the second with different URLs
+DATABASE_DIR = "logbook.nsf"
+VIEW_IDS = ("5d1a0fa27b6ec4f8c1256f9a0041d4c2", "9f0c3e4a1bd2e7a5c1256f9a0041d4c3")
+
+# prefix of links from documents to documents and media, relative to the document, as converted by
+# the scraper; this resolves from both views
+LINK_PREFIX = "../%s/" % VIEW_IDS[0]
+
+# date of the first page
+START_DATE = datetime.datetime(2005, 1, 3, 9, 0)
+
+WORDS = ("laser", "mirror", "cavity", "lock", "alignment", "vacuum", "tank", "pump", "beam",
+         "photodiode", "mode", "cleaner", "suspension", "coil", "driver", "noise", "spectrum",
+         "calibration", "filter", "seismic", "isolation", "temperature", "drift", "power",
+         "injection", "readout", "channel", "signal", "loop", "gain", "measured", "adjusted",
+         "replaced", "checked", "installed", "the", "a", "and", "with", "after", "before", "on",
+         "in", "of", "to", "was", "is", "now", "again", "today", "café", "résumé", "naïve")
+AUTHORS = ("Alice Example", "Bob Example", "Carol Example", "Dan Example", "Eve Example",
+           "Frank Example", "Grace Example", "Heidi Example")
+CATEGORIES = ("Laser", "Vacuum", "Optics", "Electronics", "Computing", "Suspensions",
+              "Infrastructure", "Detector")
+
+# media kinds, with their file name stems, extensions and the bytes their files start with
+MEDIA_KINDS = (("image", "photo", ".png", b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"),
+               ("image", "plot", ".gif", b"GIF89a"),
+               ("image", "scan", ".jpg", b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"),
+               ("attachment", "report", ".pdf", b"%PDF-1.4\n"),
+               ("attachment", "data", ".zip", b"PK\x03\x04"))
+
+# junk found in some scraped pages
+CONTROL_CHARACTERS = ("\x0b", "\x1a", "\x1f")
+
+
+class SyntheticCorpus:
+    """Generates a fake scraped Lotus Notes logbook
+
+    The files are laid out as scripts/scrape.sh saves them: a contents page listing pages and their
+    responses, newest first, and the documents it links to, with embedded images and attached
+    files. Some documents have duplicates under another view, some are orphans only linked from
+    other documents, some are encoded as windows-1252 instead of UTF-8 and some contain control
+    characters. The same seed always generates the same files.
+    """
+
+    def __init__(self, root_dir, pages=1000, response_fraction=0.2, duplicate_fraction=0.02,
+                 orphan_fraction=0.01, media_per_page=1, distinct_media=None, media_size=16384,
+                 links_per_page=2, paragraphs=3, legacy_encoding_fraction=0.02,
+                 junk_fraction=0.005, seed=0):
+        self.root_dir = root_dir
+        # number of pages on the contents page
+        self.pages = int(pages)
+        # fractions of pages with responses, with duplicates and with orphans linked from them
+        self.response_fraction = response_fraction
+        self.duplicate_fraction = duplicate_fraction
+        self.orphan_fraction = orphan_fraction
+        # average number of media files linked from each page
+        self.media_per_page = media_per_page
+        # number of different media files, which are attached to several pages when fewer than
+        # the number of media links (None for one per ten pages)
+        if distinct_media is None:
+            distinct_media = max(1, self.pages // 10)
+        self.distinct_media = int(distinct_media)
+        # average size of media files, in bytes
+        self.media_size = int(media_size)
+        # average number of links from each page to other pages
+        self.links_per_page = links_per_page
+        # average number of paragraphs in each page
+        self.paragraphs = paragraphs
+        # fractions of documents encoded as windows-1252 and containing control characters
+        self.legacy_encoding_fraction = legacy_encoding_fraction
+        self.junk_fraction = junk_fraction
+        self.seed = seed
+
+        self._random = None
+        self._stats = None
+
+    @property
+    def contents_path(self):
+        return os.path.join(self.root_dir, CONTENTS_PAGE)
+
+    @property
+    def view_dirs(self):
+        return [os.path.join(self.root_dir, DATABASE_DIR, view_id) for view_id in VIEW_IDS]
+
+    def generate(self):
+        """Write the logbook to the root directory, returning counts of what was written"""
+        self._random = random.Random(self.seed)
+        self._stats = dict.fromkeys(("pages", "responses", "duplicates", "orphans", "media_files",
+                                     "media_bytes", "documents_bytes", "legacy_encoded",
+                                     "with_junk"), 0)
+
+        for view_dir in self.view_dirs:
+            os.makedirs(view_dir, exist_ok=True)
+
+        LOGGER.info("Generating %i synthetic pages in %s", self.pages, self.root_dir)
+
+        page_ids = [self._document_id() for _ in range(self.pages)]
+        contents_rows = []
+
+        for index, page_id in enumerate(page_ids):
+            title = self._title()
+            created = START_DATE + datetime.timedelta(hours=index * 7 + self._random.randint(0, 6),
+                                                      minutes=self._random.randint(0, 59))
+
+            # cross references to earlier pages, and sometimes to the next page
+            links = [page_ids[self._random.randrange(index)]
+                     for _ in range(self._count(self.links_per_page)) if index > 0]
+
+            if index + 1 < self.pages and self._random.random() < 0.1:
+                links.append(page_ids[index + 1])
+
+            if self._random.random() < self.orphan_fraction:
+                orphan_id = self._document_id()
+                links.append(orphan_id)
+                self._write_document(orphan_id, "Orphan: " + self._title(), None, created,
+                                     self._sample(AUTHORS, 1, 2), self._sample(CATEGORIES, 0, 2),
+                                     [])
+                self._stats["orphans"] += 1
+
+            markup = self._write_document(page_id, title, str(index + 1), created,
+                                          self._sample(AUTHORS, 1, 3),
+                                          self._sample(CATEGORIES, 0, 3), links)
+            self._stats["pages"] += 1
+
+            if self._random.random() < self.duplicate_fraction:
+                # the same document, found by the scraper under another view
+                self._write_file(os.path.join(self.view_dirs[1], page_id + "?OpenDocument"),
+                                 markup)
+                self._stats["duplicates"] += 1
+
+            rows = [self._contents_row(page_id, title, str(index + 1))]
+
+            if self._random.random() < self.response_fraction:
+                for number in range(self._random.randint(1, 3)):
+                    response_id = self._document_id()
+                    response_created = created + datetime.timedelta(hours=number + 1)
+                    self._write_document(response_id, "Re: " + title, None, response_created,
+                                         self._sample(AUTHORS, 1, 1), [], [page_id])
+                    rows.append(self._contents_row(response_id, "---------- Respond: Re: " + title))
+                    self._stats["responses"] += 1
+
+            contents_rows.append("".join(rows))
+
+        # newest first
+        contents_rows.reverse()
+
+        with open(self.contents_path, "w", encoding="utf-8") as obj:
+            obj.write('<html><head><title>By Author</title></head><body text="#000000">'
+                      '<table border="0" cellpadding="2" cellspacing="0">')
+
+            for row in contents_rows:
+                obj.write(row)
+
+            obj.write("</table></body></html>")
+
+        LOGGER.info("Generated %i pages, %i responses, %i duplicates, %i orphans and %i media "
+                    "files", self._stats["pages"], self._stats["responses"],
+                    self._stats["duplicates"], self._stats["orphans"], self._stats["media_files"])
+
+        return dict(self._stats)
+
+    def _count(self, mean):
+        """Random count with the specified mean"""
+        whole = int(mean)
+        return whole + (self._random.random() < mean - whole)
+
+    def _document_id(self):
+        return "%032x" % self._random.getrandbits(128)
+
+    def _sample(self, population, minimum, maximum):
+        return self._random.sample(population, self._random.randint(minimum, maximum))
+
+    def _words(self, minimum, maximum):
+        return " ".join(self._random.choice(WORDS)
+                        for _ in range(self._random.randint(minimum, maximum)))
+
+    def _title(self):
+        return self._words(2, 8).capitalize()
+
+    def _contents_row(self, document_id, title, number=None):
+        href = "%s/%s/%s?OpenDocument" % (DATABASE_DIR, VIEW_IDS[0], document_id)
+        row = ('<tr valign="top"><td><a href="%s" target="NotesView">%s</a></td>'
+               '<td><font size="2">%s</font></td>' % (href, title, self._random.choice(AUTHORS)))
+
+        if number is not None:
+            row += '<td><font size="2">%s</font></td>' % number
+
+        return row + "</tr>"
+
+    def _write_document(self, document_id, title, number, created, authors, categories, links):
+        """Write document to the first view, returning its bytes"""
+        body = []
+
+        for _ in range(self._count(self.paragraphs)):
+            body.append("<p><font face=\"Arial\">%s.</font></p>" % self._words(10, 60).capitalize())
+
+        for link_id in links:
+            body.append('<p>See <a href="%s%s?OpenDocument">%s</a>.</p>'
+                        % (LINK_PREFIX, link_id, link_id[:8]))
+
+        for _ in range(self._count(self.media_per_page)):
+            body.append(self._media_link(document_id))
+
+        if self._random.random() < self.junk_fraction:
+            body.insert(self._random.randint(0, len(body)),
+                        self._random.choice(CONTROL_CHARACTERS))
+            self._stats["with_junk"] += 1
+
+        if number is None:
+            # responses and orphans have no page numbers on the contents page, but have their own
+            number = str(self._random.randint(1, max(1, self.pages)))
+
+        date_str = created.strftime("%m/%d/%Y")
+        time_str = created.strftime("%I:%M %p")
+
+        markup = ('<html><head><title>%s</title></head><body text="#000000">'
+                  '<div align="center"><b><font size="4" color="#0000FF">Logbook Entry</font></b></div>'
+                  '<table width="100%%" border="1"><tr valign="top">'
+                  '<td bgcolor="#EFEFEF" width="1%%"><font size="2">Page</font><b>%s</b><br/>'
+                  '<font size="2">Created</font><br/><b>%s %s</b></td>'
+                  '<td><font size="2">Title</font><font size="2">%s</font>'
+                  '<font size="2">Author</font><font size="2">%s</font>'
+                  '<font size="2">Category</font><font size="2">%s</font>'
+                  '<font size="2">Date</font><font size="2">%s</font></td></tr></table>'
+                  '%s<a href="#top">top</a></body></html>'
+                  % (title, number, date_str, time_str, title, ", ".join(authors),
+                     ", ".join(categories), date_str, "".join(body)))
+
+        if self._random.random() < self.legacy_encoding_fraction:
+            data = markup.encode("windows-1252")
+            self._stats["legacy_encoded"] += 1
+        else:
+            data = markup.encode("utf-8")
+
+        self._write_file(os.path.join(self.view_dirs[0], document_id + "?OpenDocument"), data)
+
+        return data
+
+    def _media_link(self, document_id):
+        """Write a media file attached to document, returning the markup linking to it"""
+        media_index = self._random.randrange(self.distinct_media)
+        kind, stem, extension, header = MEDIA_KINDS[media_index % len(MEDIA_KINDS)]
+        filename = "%s %i%s" % (stem, media_index, extension)
+
+        # media files are in the document's $FILE directory
+        href = "%s%s/$FILE/%s" % (LINK_PREFIX, document_id, urllib.parse.quote(filename))
+        path = os.path.join(self.view_dirs[0], document_id, "$FILE", filename)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write_file(path, self._media_data(media_index, header), media=True)
+
+        if kind == "image":
+            return '<p><img src="%s" width="400"/></p>' % href
+
+        return '<p><a href="%s">%s</a></p>' % (href, filename)
+
+    def _media_data(self, media_index, header):
+        # the same media index always has the same contents, so duplicated media hash the same
+        media_random = random.Random("%s-%i" % (self.seed, media_index))
+        size = media_random.randint(self.media_size // 2, self.media_size * 3 // 2)
+
+        size = max(0, size - len(header))
+
+        return header + media_random.getrandbits(size * 8).to_bytes(size, "little")
+
+    def _write_file(self, path, data, media=False):
+        with open(path, "wb") as obj:
+            obj.write(data)
+
+        if media:
+            self._stats["media_files"] += 1
+            self._stats["media_bytes"] += len(data)
+        else:
+            self._stats["documents_bytes"] += len(data)
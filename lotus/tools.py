@@ -1,7 +1,24 @@
 import os
+import errno
+import shutil
 import contextlib
+import hashlib
 import re
 
+try:
+    import fcntl
+except ImportError:
+    # not available on this platform
+    fcntl = None
+
+# ioctl request to clone a file's extents (Linux FICLONE)
+FICLONE = 0x40049409
+
+# methods of archiving files to try in turn for each strategy
+ARCHIVE_STRATEGIES = {"copy": ("copy",),
+                      "reflink": ("reflink", "copy_file_range", "copy"),
+                      "hardlink": ("hardlink", "reflink", "copy_file_range", "copy")}
+
 @contextlib.contextmanager
 def working_directory(path):
     # previous directory
@@ -16,6 +33,98 @@ def working_directory(path):
     # change directory back to previous path
     os.chdir(previous_path)
 
+def file_md5(path):
+    """MD5 hex digest of the contents of the file at path"""
+    md5 = hashlib.md5()
+
+    with open(path, 'rb') as obj:
+        while True:
+            data = obj.read(1048576)
+
+            if not data:
+                # end of file
+                break
+
+            md5.update(data)
+
+    return md5.hexdigest()
+
+def write_if_changed(path, data):
+    """Write bytes to path unless the file already has exactly this content
+
+    Returns True if the file was written.
+    """
+    if os.path.isfile(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as obj:
+            if obj.read() == data:
+                return False
+
+    with open(path, 'wb') as obj:
+        obj.write(data)
+
+    return True
+
+def _hardlink(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    os.link(source, destination)
+
+    return 0
+
+def _reflink(source, destination):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflinks not supported on this platform")
+
+    with open(source, 'rb') as source_obj, open(destination, 'wb') as destination_obj:
+        fcntl.ioctl(destination_obj.fileno(), FICLONE, source_obj.fileno())
+
+    return 0
+
+def _copy_file_range(source, destination):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOTSUP, "copy_file_range not supported on this platform")
+
+    with open(source, 'rb') as source_obj, open(destination, 'wb') as destination_obj:
+        remaining = os.fstat(source_obj.fileno()).st_size
+
+        while remaining > 0:
+            copied = os.copy_file_range(source_obj.fileno(), destination_obj.fileno(), remaining)
+
+            if copied == 0:
+                # file was truncated while copying
+                break
+
+            remaining -= copied
+
+    return os.path.getsize(destination)
+
+def _copy(source, destination):
+    shutil.copyfile(source, destination)
+
+    return os.path.getsize(destination)
+
+_ARCHIVE_METHODS = {"hardlink": _hardlink, "reflink": _reflink,
+                    "copy_file_range": _copy_file_range, "copy": _copy}
+
+def archive_file(source, destination, strategy="copy"):
+    """Archive file at source to destination using the first method of strategy that works
+
+    Returns the method used and the number of bytes copied (zero if the data is shared).
+    """
+    methods = ARCHIVE_STRATEGIES[strategy]
+
+    for method in methods[:-1]:
+        try:
+            return method, _ARCHIVE_METHODS[method](source, destination)
+        except OSError:
+            # not supported for these files, e.g. they're on different file systems
+            continue
+
+    method = methods[-1]
+
+    return method, _ARCHIVE_METHODS[method](source, destination)
+
 def sanitize_title(text):
     """Approximate clone of WordPress's sanitize_title_with_dashes
     https://github.com/WordPress/WordPress/blob/be6aa715fedb64fba8a848706e050f489c56df82/wp-includes/formatting.php#L2204
@@ -1,13 +1,277 @@
 import os
-import logging
+import re
+import json
+import uuid
+import contextlib
 from random import randint
 import datetime
 import urllib.parse
-import glob
 import pytz
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
 
 from .tools import working_directory, sanitize_title
+from .store import PAGE_ARCHIVES, PageIndex, open_page_store, parse_page
+from .postids import PostIdAllocator
+from .delta import ExportState
+from .stats import Stats, Progress, collecting
+from .logs import setup_logging
+
+# hashes that links to pages and media are replaced with in archived content, in the attributes
+# they're replaced in
+PLACEHOLDER_PATTERN = re.compile(r'(<a )?(href|src)="([0-9a-f]{32})"')
+
+# text put in place of the ids allocated when generated items are written; random so that it can't
+# be in page content
+ID_PLACEHOLDER = uuid.uuid4().hex
+
+# writer and post ids used to generate posts in worker processes
+_worker_writer = None
+_worker_post_id_map = None
+
+
+def namespace_declarations(nsmap):
+    """Namespace declarations lxml copies to each element serialised from a parent with nsmap"""
+    empty_item = etree.tostring(etree.SubElement(etree.Element("channel", nsmap=nsmap), "item"))
+    return empty_item[len(b"<item"):-len(b"/>")]
+
+def _set_worker_writer(writer, post_id_map):
+    global _worker_writer, _worker_post_id_map
+
+    _worker_writer = writer
+    _worker_post_id_map = post_id_map
+
+def _generate_post_items(data, post_id):
+    """Generate items of archived page data in a worker process, with the statistics recorded
+
+    This is a module level function so that it can be sent to worker processes.
+    """
+    with collecting() as stats:
+        with stats.timer("wxr.post"):
+            generated = _worker_writer.generate_post_items(parse_page(data), post_id,
+                                                           _worker_post_id_map)
+
+    generated.stats = stats
+
+    return generated
+
+
+class GeneratedPost:
+    """Serialised items of a post and its media, split where ids allocated as they're written go
+
+    Comment ids and media post ids are allocated in the order posts are written, so that they're
+    the same however the posts are generated.
+    """
+
+    def __init__(self):
+        # parts of the post item between its comment ids, or None if the post was skipped
+        self.post = None
+        # kinds ("attachment" or "image") and archive paths of media in the post, with the parts of
+        # their items before and after their post ids
+        self.media = []
+        # number of links to other posts
+        self.nurls = 0
+        # statistics recorded generating the post in a worker process
+        self.stats = None
+
+    @staticmethod
+    def split(data, nids):
+        parts = data.split(ID_PLACEHOLDER.encode("ascii"))
+
+        if len(parts) != nids + 1:
+            raise ValueError("id placeholder found in content")
+
+        return parts
+
+    @staticmethod
+    def join(parts, ids):
+        data = [parts[0]]
+
+        for post_id, part in zip(ids, parts[1:]):
+            data.append(str(post_id).encode("ascii"))
+            data.append(part)
+
+        return b"".join(data)
+
+
+class ContentRewriter:
+    """Replaces the hashes in archived page content with URLs, in a single pass over the content
+
+    Links to pages are replaced in a tags' href attributes, and links to media in any href or src
+    attribute. The first URL added for each hash is used.
+    """
+
+    def __init__(self):
+        # hashes -> URLs
+        self.page_urls = {}
+        self.media_urls = {}
+
+    def add_page(self, unique_hash, url):
+        self.page_urls.setdefault(unique_hash, url)
+
+    def add_media(self, unique_hash, url):
+        self.media_urls.setdefault(unique_hash, url)
+
+    def _replace(self, match):
+        tag, attribute, unique_hash = match.groups()
+
+        if tag and attribute == "href" and unique_hash in self.page_urls:
+            url = self.page_urls[unique_hash]
+        elif unique_hash in self.media_urls:
+            url = self.media_urls[unique_hash]
+        else:
+            return match.group()
+
+        return '%s%s="%s"' % (tag or "", attribute, url)
+
+    def rewrite(self, content):
+        if not content or not (self.page_urls or self.media_urls):
+            return content
+
+        return PLACEHOLDER_PATTERN.sub(self._replace, content)
+
+
+class WXRStream:
+    """Writes the WordPress import file as items are generated
+
+    The rss and channel elements are written with etree.xmlfile, and items are written as they're
+    serialised, so memory use doesn't grow with the site.
+
+    If a maximum number of posts or bytes per file is specified, the import file is split into
+    shards that can be imported one at a time, and the shards are listed in order in a manifest.
+    Each shard starts with the header, authors and categories, and posts are written to the same
+    shard as the media items generated with them.
+    """
+
+    def __init__(self, path, nsmap, pretty_print=False, shard_posts=None, shard_bytes=None):
+        self.path = path
+        self.nsmap = nsmap
+        self.pretty_print = pretty_print
+        self.shard_posts = shard_posts
+        self.shard_bytes = shard_bytes
+
+        # files written, in order, with their numbers of posts and sizes
+        self.shards = []
+        self.nbytes = 0
+
+        # header, authors and categories, repeated at the start of each shard
+        self._header = b""
+        self._shard = None
+        self._shard_path = None
+        self._stack = None
+        self._file = None
+        self._xf = None
+
+    @property
+    def sharded(self):
+        return self.shard_posts is not None or self.shard_bytes is not None
+
+    @property
+    def manifest_path(self):
+        root, _ = os.path.splitext(self.path)
+        return root + "-manifest.json"
+
+    def shard_path(self, number):
+        root, ext = os.path.splitext(self.path)
+        return "%s-%04i%s" % (root, number, ext)
+
+    def __enter__(self):
+        self._open()
+        return self
+
+    def __exit__(self, *exc_info):
+        result = self._close(*exc_info)
+
+        if exc_info[0] is None and self.sharded:
+            self._write_manifest()
+
+        return result
+
+    def _open(self):
+        if self.sharded:
+            self._shard_path = self.shard_path(len(self.shards) + 1)
+        else:
+            self._shard_path = self.path
+
+        self._stack = contextlib.ExitStack()
+
+        try:
+            self._file = self._stack.enter_context(open(self._shard_path, "wb"))
+            # after the rss end tag, which xmlfile won't write anything after
+            self._stack.callback(self._newline, raw=True)
+            self._xf = self._stack.enter_context(etree.xmlfile(self._file))
+            self._stack.enter_context(self._xf.element("rss", version="2.0", nsmap=self.nsmap))
+            self._newline()
+            # after the channel end tag
+            self._stack.callback(self._newline)
+            self._stack.enter_context(self._xf.element("channel"))
+            self._newline()
+        except:
+            self._stack.close()
+            raise
+
+        self._shard = {"file": os.path.basename(self._shard_path), "posts": 0, "bytes": 0}
+        self.shards.append(self._shard)
+
+    def _close(self, *exc_info):
+        result = self._stack.__exit__(*exc_info)
+
+        self._shard["bytes"] = os.path.getsize(self._shard_path)
+        self.nbytes += self._shard["bytes"]
+
+        return result
+
+    def _newline(self, raw=False):
+        if not self.pretty_print:
+            return
+
+        if raw:
+            self._file.write(b"\n")
+        else:
+            self._xf.write("\n")
+
+    def _write(self, data):
+        # write the start tags still buffered by xmlfile first
+        self._xf.flush()
+        self._file.write(data)
+        self._shard["bytes"] += len(data)
+
+    def _full(self, nbytes):
+        """Check if nbytes more would take the current shard over its limits"""
+        if not self.sharded or not self._shard["posts"]:
+            # shards have at least one post, however big
+            return False
+        elif self.shard_posts is not None and self._shard["posts"] >= self.shard_posts:
+            return True
+
+        return self.shard_bytes is not None and self._shard["bytes"] + nbytes > self.shard_bytes
+
+    def write_header(self, data):
+        """Write the serialised header, authors and categories"""
+        self._header = data
+        self._write(self._header)
+
+    def write(self, data, posts=0):
+        """Write serialised items, containing the specified number of posts"""
+        if self._full(len(data)):
+            self._close(None, None, None)
+            self._open()
+            self._write(self._header)
+
+        self._write(data)
+        self._shard["posts"] += posts
+
+    def _write_manifest(self):
+        data = {"shards": self.shards, "posts": sum(shard["posts"] for shard in self.shards)}
+
+        # replaced atomically, so it never lists shards from different runs
+        temporary_path = "%s.%i.tmp" % (self.manifest_path, os.getpid())
+
+        with open(temporary_path, "w") as obj:
+            json.dump(data, obj, indent=1)
+
+        os.replace(temporary_path, self.manifest_path)
+
 
 class WordPressXMLWriter:
     # namespaces
@@ -21,8 +285,13 @@ class WordPressXMLWriter:
     WP_POST_DATE_FORMAT = r"%Y-%m-%d %H:%M:%S"
     WP_POST_DATE_GMT_FORMAT = r"%Y-%m-%d %H:%M:%S"
 
+    # largest number of posts sent to a worker process at once
+    MAX_CHUNK_SIZE = 16
+
     def __init__(self, title, archive_dir, wp_file, site_id, base_network_url, base_url,
-                 base_source_media_url, debug_log_file=None):
+                 base_source_media_url, debug_log_file=None, page_archive="directory",
+                 stats_file=None, quiet=None, pretty_print=False, shard_posts=None,
+                 shard_bytes=None, post_id_file=None, jobs=None, export_state_file=None):
         if not base_url.endswith("/"):
             # required for joining URLs
             base_url += "/"
@@ -43,16 +312,33 @@ class WordPressXMLWriter:
         self.base_url = base_url
         self.base_source_media_url = base_source_media_url
 
-        self.added_post_ids = []
+        if page_archive not in PAGE_ARCHIVES:
+            raise ValueError("page archive must be one of %s" % ", ".join(PAGE_ARCHIVES))
+
+        # how the archived pages are stored ("directory" or "packed"), as set in LotusXMLBuilder
+        self.page_archive = page_archive
+        self.page_store = None
+
+        # post ids given to pages and media, and path of file to keep them in between runs so
+        # regenerated import files use the same ones
+        self.post_ids = None
+        self.post_id_file = post_id_file
+
+        # what previous import files had, and path of file to keep it in between runs so only new
+        # and changed posts are written
+        self.export_state = None
+        self.export_state_file = export_state_file
+
         # author display names -> ids
         self.added_author_map = {}
         self.last_author_id = 0
         self.last_comment_id = 0
         self.last_term_id = 0
-        self.attachment_filenames = []
-        self.image_filenames = []
+        # kinds and archive paths of media with items written
+        self.media_written = set()
 
         self.nposts = 0
+        self.nunchanged = 0
         self.ncomments = 0
         self.nimages = 0
         self.nattachments = 0
@@ -60,37 +346,52 @@ class WordPressXMLWriter:
         self.nauthors = 0
         self.ncategories = 0
 
-        self._setup_logging(debug_log_file)
-
-    def _setup_logging(self, debug_log_file):
-        # base logger
-        self.logger = logging.getLogger("lotus")
-        self.logger.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(name)-25s - %(levelname)-8s - %(message)s")
-
-        # log INFO or higher to stdout
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(formatter)
-        stream_handler.setLevel(logging.INFO)
-        self.logger.addHandler(stream_handler)
-
-        if debug_log_file is not None:
-            # delete existing log file
-            if os.path.exists(debug_log_file):
-                os.remove(debug_log_file)
-                
-            # log DEBUG or higher to file
-            file_handler = logging.FileHandler(debug_log_file)
-            file_handler.setFormatter(formatter)
-            file_handler.setLevel(logging.DEBUG)
-            self.logger.addHandler(file_handler)
-
-    def _xml_streamer(self):
+        # timings and counts of each stage, and path to write them to at the end (JSON, or
+        # Prometheus text format if the path ends with .prom)
+        self.stats = Stats()
+        self.stats_file = stats_file
+
+        # indent the WordPress import file, which makes it larger and slower to write
+        self.pretty_print = pretty_print
+        self._namespace_declarations = namespace_declarations(self.NSMAP)
+
+        # split the import file into shards of at most this many posts or bytes (each shard still
+        # has at least one post), written next to wp_file and listed in a manifest
+        self.shard_posts = None if shard_posts is None else int(shard_posts)
+        self.shard_bytes = None if shard_bytes is None else int(shard_bytes)
+
+        # number of processes to generate posts in (None or 1 to generate them in this process)
+        self.jobs = jobs
+
+        self.logger = setup_logging(debug_log_file, quiet=quiet)
+
+    def __getstate__(self):
+        # worker processes don't read the page store or allocate post ids
+        state = dict(self.__dict__)
+        state["page_store"] = None
+        state["post_ids"] = None
+        state["export_state"] = None
+
+        return state
+
+    def _new_channel(self):
+        """Element to generate items in before they're serialised
+
+        Items are generated in a channel rather than on their own so that they use the namespace
+        prefixes WordPress expects.
+        """
+        return etree.Element("channel", nsmap=self.NSMAP)
+
+    def _serialize(self, elements):
+        # lxml copies the channel's namespace declarations to each element, but they're already
+        # made on the rss element
+        return b"".join(etree.tostring(element, pretty_print=self.pretty_print)
+                        .replace(self._namespace_declarations, b"", 1) for element in elements)
+
+    def _generate_header(self, channel):
         # current time
         now = datetime.datetime.now(pytz.utc)
 
-        document = etree.Element("rss", version="2.0", nsmap=self.NSMAP)
-        channel = etree.SubElement(document, "channel")
         title = etree.SubElement(channel, "title")
         title.text = self.title
         link = etree.SubElement(channel, "link")
@@ -110,18 +411,9 @@ class WordPressXMLWriter:
         generator = etree.SubElement(channel, "generator")
         generator.text = "dump-lotus"
 
-        return document, channel
-
-    def unique_post_id(self):
-        """Get unique post id"""
-        candidate_post_id = max(self.added_post_ids) + 1
-
-        while candidate_post_id in self.added_post_ids:
-            candidate_post_id += 1
-        
-        self.added_post_ids.append(candidate_post_id)
-
-        return candidate_post_id
+    def unique_post_id(self, key):
+        """Get unique post id for page hash, or media file kind and filename"""
+        return self.post_ids.allocate(key)
 
     def unique_author_id(self):
         """Get unique author id"""
@@ -150,10 +442,6 @@ class WordPressXMLWriter:
     def base_media_url(self):
         return self.base_url + "wp-content/uploads/sites/" + str(self.site_id) + "/"
 
-    @property
-    def page_filenames(self):
-        return glob.glob(self.page_dir + "/*.xml")
-
     @property
     def author_xml_path(self):
         return os.path.join(self.meta_dir, "authors.xml")
@@ -162,61 +450,61 @@ class WordPressXMLWriter:
     def category_xml_path(self):
         return os.path.join(self.meta_dir, "categories.xml")
 
+    @property
+    def page_index_path(self):
+        return os.path.join(self.meta_dir, "page-index.json")
+
     def _post_xml_by_hash(self, unique_hash):
-        path = os.path.join(self.page_dir, unique_hash + ".xml")
+        with self.stats.timer("page.load"):
+            return self.page_store.load(unique_hash)
 
-        return etree.parse(path).getroot()
+    def _page_numbers(self):
+        """Hashes of archived pages, with their page numbers and titles"""
+        page_hashes = self.page_store.hashes()
+        index = PageIndex.load(self.page_index_path)
 
-    def _generate_post_id_hash_map(self):
-        unique_hash_to_post_id = {}
-        
-        for path in self.page_filenames:
-            # remove symlinks
-            path = os.path.normpath(path)
+        if index is not None and index.hashes() == page_hashes:
+            for unique_hash in page_hashes:
+                entry = index.entries[unique_hash]
+                yield unique_hash, entry["page"], entry["title"]
 
+            return
+
+        # archived by an earlier version, or changed since
+        self.logger.info("page index missing or out of date; reading page numbers from pages")
+
+        for unique_hash in page_hashes:
             # parse XML
-            page = etree.parse(path).getroot()
+            page = self._post_xml_by_hash(unique_hash)
 
-            # extract unique hash from filename
-            unique_hash = os.path.basename(path).rstrip(".xml")
+            yield unique_hash, page.find("page").text, page.find("title").text
 
+    def _generate_post_id_hash_map(self):
+        unique_hash_to_post_id = {}
+        
+        for unique_hash, page_number_str, page_title in self._page_numbers():
             # extract page number
-            page_number_str = page.find("page").text
             try:
                 page_number = int(page_number_str)
             except ValueError:
                 # invalid page number, e.g. a float
-                force_new = True
-            else:
-                force_new = False
+                page_number = None
 
             # assign a unique post id to this page
-            post_id_clashes = []
-            if page_number in self.added_post_ids or force_new:
-                # post id clash
-                post_id_clashes.append(unique_hash)
+            if self.post_ids.previous_id(unique_hash) is not None:
+                # keep the post id given on a previous run
+                post_id = self.unique_post_id(unique_hash)
+            elif page_number is not None and self.post_ids.claim(unique_hash, page_number):
+                post_id = page_number
             else:
-                self.added_post_ids.append(page_number)
-
-                # store unique hash -> post id
-                unique_hash_to_post_id[unique_hash] = page_number
-            
-            # deal with duplicates
-            candidate_post_id = max(self.added_post_ids) + 1
-
-            while post_id_clashes:
-                while candidate_post_id in self.added_post_ids:
-                    candidate_post_id += 1
-                
-                # get next clashing post
-                unique_hash = post_id_clashes.pop(0)
-                unique_hash_to_post_id[unique_hash] = candidate_post_id
-                self.added_post_ids.append(candidate_post_id)
+                # post id clash
+                post_id = self.unique_post_id(unique_hash)
 
                 self.logger.warning("assigned clashing page number %s (%s) to %i",
-                                    page_number_str, page.find("title").text, candidate_post_id)
+                                    page_number_str, page_title, post_id)
 
-                candidate_post_id += 1
+            # store unique hash -> post id
+            unique_hash_to_post_id[unique_hash] = post_id
 
         return unique_hash_to_post_id
 
@@ -225,21 +513,24 @@ class WordPressXMLWriter:
         author_data = etree.parse(self.author_xml_path).getroot()
 
         for author in author_data:
-            author_id = self.unique_author_id()
-
             # author display name
             author_display_name = author.text
+
+            # keep the id given in previous import files, which comments refer to
+            author_id = self.export_state.authors.get(author_display_name)
+
+            if author_id is None:
+                author_id = self.unique_author_id()
+
             author_nicename = self.sanitize_author(author.text)
             
             # URL-friendly author name
             term_slug = self.author_term_name(author_nicename)
 
-            term_id = self.unique_term_id()
-
             # terms have slug: ssl-alp-coauthor-[nicename]
             # and name: [display name]
 
-            # author
+            # author, written to every import file so the importer can map posts to it
             wp_author = etree.SubElement(channel, "{http://wordpress.org/export/1.2/}author")
             etree.SubElement(wp_author, "{http://wordpress.org/export/1.2/}author_id").text = etree.CDATA(str(author_id))
             etree.SubElement(wp_author, "{http://wordpress.org/export/1.2/}author_login").text = etree.CDATA(author_nicename)
@@ -248,6 +539,18 @@ class WordPressXMLWriter:
             etree.SubElement(wp_author, "{http://wordpress.org/export/1.2/}author_first_name").text = etree.CDATA("")
             etree.SubElement(wp_author, "{http://wordpress.org/export/1.2/}author_last_name").text = etree.CDATA("")
 
+            self.added_author_map[author_display_name] = author_id
+
+            self.nauthors += 1
+
+            if author_display_name in self.export_state.authors:
+                # term already exported
+                continue
+
+            self.export_state.authors[author_display_name] = author_id
+
+            term_id = self.unique_term_id()
+
             # coauthor term
             wp_coauthor = etree.SubElement(channel, "{http://wordpress.org/export/1.2/}term")
             etree.SubElement(wp_coauthor, "{http://wordpress.org/export/1.2/}term_id").text = etree.CDATA(str(term_id))
@@ -256,10 +559,6 @@ class WordPressXMLWriter:
             etree.SubElement(wp_coauthor, "{http://wordpress.org/export/1.2/}term_parent").text = etree.CDATA("")
             etree.SubElement(wp_coauthor, "{http://wordpress.org/export/1.2/}term_name").text = etree.CDATA(author_display_name)
 
-            self.added_author_map[author_display_name] = author_id
-
-            self.nauthors += 1
-
     def _generate_categories(self, channel):
         # parse categories
         categories = etree.parse(self.category_xml_path).getroot()
@@ -267,6 +566,12 @@ class WordPressXMLWriter:
             category_name = category.text
             category_nicename = sanitize_title(category_name)
 
+            if category_name in self.export_state.categories:
+                # already exported
+                continue
+
+            self.export_state.categories.add(category_name)
+
             term_id = self.unique_term_id()
 
             wp_category = etree.SubElement(channel, "{http://wordpress.org/export/1.2/}category")
@@ -277,7 +582,8 @@ class WordPressXMLWriter:
 
             self.ncategories += 1
 
-    def _generate_attachment(self, attachment, channel, content, parent_post_id, first_author):
+    def _generate_attachment(self, attachment, channel, rewriter, parent_post_id, first_author,
+                             media, written_media):
         # file path
         attachment_path = attachment.attrib["path"]
         
@@ -287,11 +593,8 @@ class WordPressXMLWriter:
         # hash
         attachment_hash = attachment.text
 
-        # file data
-        filestats = os.stat(attachment_path)
-
-        # make the creation time the modification time, which is set to the file's original creation time
-        attachment_created = datetime.datetime.fromtimestamp(filestats.st_mtime)
+        # creation time
+        attachment_created = self.media_created(attachment)
 
         # create fake WordPress file path, to trick import to use the original modified date
         # YYYY/MM/filename.jpg
@@ -302,14 +605,11 @@ class WordPressXMLWriter:
         new_url = self.base_media_url + fake_wp_file_path
 
         # replace all href and src tags with new path
-        content = content.replace("href=\"%s\"" % attachment_hash, "href=\"%s\"" % new_url)
-        content = content.replace("src=\"%s\"" % attachment_hash, "src=\"%s\"" % new_url)
+        rewriter.add_media(attachment_hash, new_url)
 
-        if attachment_path in self.attachment_filenames:
+        if ("attachment", attachment_path) in written_media:
             # skip adding, as this already exists
-            return content
-        else:
-            self.attachment_filenames.append(attachment_path)
+            return
 
         # slug
         attachment_slug = sanitize_title(attachment_filename)
@@ -317,8 +617,8 @@ class WordPressXMLWriter:
         # media URL
         media_url = self.base_source_media_url + attachment_filename
 
-        # new post id
-        attachment_post_id = self.unique_post_id()
+        # new post id, allocated when written
+        attachment_post_id = ID_PLACEHOLDER
 
         # create item
         attachment_item = etree.SubElement(channel, "item")
@@ -360,11 +660,10 @@ class WordPressXMLWriter:
         etree.SubElement(media_post_meta, "{http://wordpress.org/export/1.2/}meta_key").text = etree.CDATA("_wp_attached_file")
         etree.SubElement(media_post_meta, "{http://wordpress.org/export/1.2/}meta_value").text = etree.CDATA(fake_wp_file_path)
 
-        self.nattachments += 1
-
-        return content
+        media.append(("attachment", attachment_path))
 
-    def _generate_image(self, image, channel, content, parent_post_id, first_author):
+    def _generate_image(self, image, channel, rewriter, parent_post_id, first_author, media,
+                        written_media):
         # file path
         image_path = image.attrib["path"]
         
@@ -374,9 +673,8 @@ class WordPressXMLWriter:
         # hash
         image_hash = image.text
 
-        # file data
-        filestats = os.stat(image_path)
-        image_created = datetime.datetime.fromtimestamp(filestats.st_ctime)
+        # creation time
+        image_created = self.media_created(image)
 
         # create fake WordPress file path, to trick import to use the original modified date
         # YYYY/MM/filename.jpg
@@ -387,14 +685,11 @@ class WordPressXMLWriter:
         new_url = self.base_media_url + fake_wp_file_path
 
         # replace all href and src tags with new path
-        content = content.replace("href=\"%s\"" % image_hash, "href=\"%s\"" % new_url)
-        content = content.replace("src=\"%s\"" % image_hash, "src=\"%s\"" % new_url)
+        rewriter.add_media(image_hash, new_url)
 
-        if image_path in self.image_filenames:
+        if ("image", image_path) in written_media:
             # skip adding, as this already exists
-            return content
-        else:
-            self.image_filenames.append(image_path)
+            return
 
         # slug
         image_slug = sanitize_title(image_filename)
@@ -402,8 +697,8 @@ class WordPressXMLWriter:
         # media URL
         media_url = self.base_source_media_url + image_filename
 
-        # new post id
-        image_post_id = self.unique_post_id()
+        # new post id, allocated when written
+        image_post_id = ID_PLACEHOLDER
 
         # create item
         image_item = etree.SubElement(channel, "item")
@@ -445,24 +740,141 @@ class WordPressXMLWriter:
         etree.SubElement(image_post_meta, "{http://wordpress.org/export/1.2/}meta_key").text = etree.CDATA("_wp_attached_file")
         etree.SubElement(image_post_meta, "{http://wordpress.org/export/1.2/}meta_value").text = etree.CDATA(fake_wp_file_path)
 
-        self.nimages += 1
+        media.append(("image", image_path))
 
-        return content
-
-    def _generate_posts(self, channel):
+    def _generate_posts(self, stream):
         # page hashes and their corresponding unique post ids
-        post_id_map = self._generate_post_id_hash_map()
+        with self.stats.timer("wxr.post_ids"):
+            post_id_map = self._generate_post_id_hash_map()
+
+        progress = Progress(self.logger, "generated", len(post_id_map), unit="posts")
+
+        # write posts in order, allocating their comment and media ids
+        for (unique_hash, post_id), generated in zip(post_id_map.items(),
+                                                     self._generated_posts(post_id_map)):
+            with self.stats.timer("wxr.write"):
+                self._write_post(stream, unique_hash, post_id, generated)
+
+            progress.update()
+
+    def _generated_posts(self, post_id_map):
+        """Generate the items of each post, in order, in worker processes if jobs is set"""
+        if self.jobs is None or self.jobs <= 1:
+            for unique_hash, post_id in post_id_map.items():
+                # load page
+                post_xml = self._post_xml_by_hash(unique_hash)
+
+                # main post
+                self.logger.debug("opening %s", unique_hash)
+
+                with self.stats.timer("wxr.post"):
+                    generated = self.generate_post_items(post_xml, post_id, post_id_map,
+                                                         self.media_written)
+
+                yield generated
+
+            return
+
+        posts = list(post_id_map.items())
+
+        # several posts are sent to each worker at once, and a limited number are read ahead
+        chunksize = max(1, min(self.MAX_CHUNK_SIZE, len(posts) // (self.jobs * 4)))
+        batch_size = self.jobs * chunksize * 8
 
-        # generate posts
-        for unique_hash, post_id in post_id_map.items():
-            # load page
-            post_xml = self._post_xml_by_hash(unique_hash)
+        self.logger.info("generating posts in %i processes", self.jobs)
 
-            # main post
-            self.logger.info("opening %s", unique_hash)
-            self._generate_post(post_xml, channel, post_id, post_id_map)
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_set_worker_writer,
+                                 initargs=(self, post_id_map)) as executor:
+            for start in range(0, len(posts), batch_size):
+                batch = posts[start:start + batch_size]
 
-    def _generate_post(self, post, channel, post_id, post_id_map):
+                # pages are sent as archived, and parsed by the workers
+                with self.stats.timer("page.load"):
+                    data = [self.page_store.read(unique_hash) for unique_hash, _ in batch]
+
+                post_ids = [post_id for _, post_id in batch]
+
+                for generated in executor.map(_generate_post_items, data, post_ids,
+                                              chunksize=chunksize):
+                    self.stats.merge(generated.stats)
+                    generated.stats = None
+
+                    yield generated
+
+    def generate_post_items(self, post, post_id, post_id_map, written_media=()):
+        """Generate and serialise the items of archived post and its media
+
+        Comment ids and media post ids are left as placeholders, to be allocated when the items are
+        written. Items aren't generated for media in written_media, a set of (kind, archive path).
+        """
+        generated = GeneratedPost()
+
+        channel = self._new_channel()
+        media = []
+
+        self._generate_post(post, channel, post_id, post_id_map, media, written_media)
+
+        if not len(channel):
+            # skipped
+            return generated
+
+        item = channel[0]
+        ncomments = len(item.findall("{http://wordpress.org/export/1.2/}comment"))
+
+        generated.post = GeneratedPost.split(self._serialize([item]), ncomments)
+        generated.nurls = len(post.find("urls"))
+
+        for (kind, path), media_item in zip(media, channel[1:]):
+            generated.media.append((kind, path,
+                                    GeneratedPost.split(self._serialize([media_item]), 1)))
+
+        return generated
+
+    def _write_post(self, stream, unique_hash, post_id, generated):
+        """Write generated post and the media items not already written, allocating their ids
+
+        If the export state is kept, posts that haven't changed since the last export are skipped.
+        """
+        if generated.post is None:
+            return
+
+        if self.export_state.path is not None:
+            digest = ExportState.digest(generated.post)
+
+            if not self.export_state.changed(unique_hash, digest):
+                self.nunchanged += 1
+                return
+            elif unique_hash in self.export_state.posts:
+                # the importer skips posts that exist, so the old one has to be deleted first
+                self.logger.info("post %i changed since the last export", post_id)
+
+            self.export_state.posts[unique_hash] = digest
+
+        comment_ids = [self.unique_comment_id() for _ in generated.post[1:]]
+        data = [GeneratedPost.join(generated.post, comment_ids)]
+
+        for kind, path, parts in generated.media:
+            if (kind, path) in self.media_written:
+                # generated in another worker process
+                continue
+
+            self.media_written.add((kind, path))
+
+            media_post_id = self.unique_post_id("%s/%s" % (kind, os.path.basename(path)))
+            data.append(GeneratedPost.join(parts, [media_post_id]))
+
+            if kind == "attachment":
+                self.nattachments += 1
+            else:
+                self.nimages += 1
+
+        self.nposts += 1
+        self.ncomments += len(comment_ids)
+        self.nurls += generated.nurls
+
+        stream.write(b"".join(data), posts=1)
+
+    def _generate_post(self, post, channel, post_id, post_id_map, media, written_media):
         # create post XML element
         item = etree.SubElement(channel, "item")
 
@@ -485,8 +897,8 @@ class WordPressXMLWriter:
 
         first_author = self.sanitize_author(first_author_element.text)
 
-        self.logger.info("adding %s (lotus p%s, created %s)", page_title, original_page_number,
-                         created)
+        self.logger.debug("adding %s (lotus p%s, created %s)", page_title, original_page_number,
+                          created)
 
         # generate categories
         for category in post.find("categories"):
@@ -508,17 +920,24 @@ class WordPressXMLWriter:
             # for empty posts
             content = ""
 
+        # URLs to replace links in post and response content with
+        rewriter = ContentRewriter()
+
         # replace cross references with proper URL
         for other_page_url in post.find("urls"):
-            content = self.replace_url(content, other_page_url, post_id_map)
+            self.add_url(rewriter, other_page_url, post_id_map)
 
         # media
         for attachment in post.find("attachments"):
-            content = self._generate_attachment(attachment, channel, content, post_id, first_author)
+            self._generate_attachment(attachment, channel, rewriter, post_id, first_author, media,
+                                      written_media)
 
         # images
         for image in post.find("images"):
-            content = self._generate_image(image, channel, content, post_id, first_author)
+            self._generate_image(image, channel, rewriter, post_id, first_author, media,
+                                 written_media)
+
+        content = rewriter.rewrite(content)
 
         # title
         etree.SubElement(item, "title").text = etree.CDATA(page_title)
@@ -553,13 +972,11 @@ class WordPressXMLWriter:
         etree.SubElement(item, "{http://wordpress.org/export/1.2/}post_password").text = ""
         etree.SubElement(item, "{http://wordpress.org/export/1.2/}is_sticky").text = "0"
 
-        self.nposts += 1
-
         # responses
         for response in post.find("responses"):
-            self._generate_comment(response, post, item, channel, post_id, page_title, post_id_map)
+            self._generate_comment(response, item, page_title, rewriter)
 
-    def _generate_comment(self, response, parent, item, channel, post_id, page_title, post_id_map):
+    def _generate_comment(self, response, item, page_title, rewriter):
         response_created = datetime.datetime.fromtimestamp(float(response.find("created").text))
         response_authors = response.find("authors")
         response_first_author_element = response_authors.find("author")
@@ -571,10 +988,9 @@ class WordPressXMLWriter:
             return
 
         response_first_author_display_name = response_first_author_element.text
-        response_first_author_nicename = self.sanitize_author(response_first_author_display_name)
         response_first_author_id = self.added_author_map[response_first_author_display_name]
 
-        self.logger.info("adding response by %s to %s", response_first_author_display_name, page_title)
+        self.logger.debug("adding response by %s to %s", response_first_author_display_name, page_title)
 
         try:
             content = response.find("content").text
@@ -582,20 +998,11 @@ class WordPressXMLWriter:
             # for empty comments
             content = ""
 
-        # replace cross references with proper URL
-        for other_page_url in parent.find("urls"):
-            content = self.replace_url(content, other_page_url, post_id_map)
+        # replace cross references and media with proper URLs, as in the parent post
+        content = rewriter.rewrite(content)
 
-        # media
-        for attachment in parent.find("attachments"):
-            content = self._generate_attachment(attachment, channel, content, post_id, response_first_author_nicename)
-
-        # images
-        for image in parent.find("images"):
-            content = self._generate_image(image, channel, content, post_id, response_first_author_nicename)
-
-        # comment id
-        comment_id = self.unique_comment_id()
+        # comment id, allocated when written
+        comment_id = ID_PLACEHOLDER
 
         response_author_display_names = [author.text for author in response_authors]
 
@@ -626,28 +1033,93 @@ class WordPressXMLWriter:
         # user id
         etree.SubElement(comment_item, "{http://wordpress.org/export/1.2/}comment_user_id").text = str(response_first_author_id)
 
-        self.ncomments += 1
+    def generate(self, page_store=None):
+        """Generate WordPress import file from archived pages
+
+        Pages are read from page_store if specified, which is left open, instead of the configured
+        page archive.
+        """
+        with collecting(self.stats):
+            with self.stats.timer("total"):
+                self._generate(page_store)
+
+        self.stats.log(self.logger)
+
+        if self.stats_file is not None:
+            self.stats.write(self.stats_file, "generate")
+            self.logger.info("wrote statistics to %s", self.stats_file)
+
+    def _generate(self, page_store):
+        self.export_state = ExportState(self.export_state_file)
+        # ids given in previous import files are kept, whether or not post_id_file is set
+        self.post_ids = PostIdAllocator(self.post_id_file, previous=self.export_state.post_ids)
+        # author, comment and term ids carry on from the last export, and exported media aren't written
+        # again
+        self.last_author_id = max(self.export_state.authors.values(), default=0)
+        self.last_comment_id = self.export_state.last_comment_id
+        self.last_term_id = self.export_state.last_term_id
+        self.media_written.update(self.export_state.media)
+
+        if page_store is not None:
+            self.page_store = page_store
+        else:
+            self.page_store = open_page_store(self.page_archive, self.archive_dir)
 
-    def generate(self):
-        # create XML streamer
-        document, channel = self._xml_streamer()
+        try:
+            # write items as they're generated, rather than building the whole document first
+            stream = WXRStream(self.wp_file, self.NSMAP, pretty_print=self.pretty_print,
+                               shard_posts=self.shard_posts, shard_bytes=self.shard_bytes)
+
+            with stream:
+                channel = self._new_channel()
+                self._generate_header(channel)
+
+                with self.stats.timer("wxr.terms"):
+                    self._generate_authors(channel)
+                    self._generate_categories(channel)
+
+                stream.write_header(self._serialize(channel))
+                self._generate_posts(stream)
+
+            # only once the import file is complete
+            self.post_ids.save()
+
+            self.export_state.media = self.media_written
+            self.export_state.post_ids = self.post_ids.all_ids()
+            self.export_state.last_comment_id = self.last_comment_id
+            self.export_state.last_term_id = self.last_term_id
+            self.export_state.save()
+        finally:
+            if page_store is None:
+                self.page_store.close()
 
-        self._generate_authors(channel)
-        self._generate_categories(channel)
-        self._generate_posts(channel)
+            self.page_store = None
 
-        with open(self.wp_file, "wb") as f:
-            tree = etree.ElementTree(document)
-            tree.write(f, pretty_print=True)
+        self.stats.add_bytes("wxr_written", stream.nbytes)
+
+        if stream.sharded:
+            self.logger.info("wrote %i shards, listed in %s", len(stream.shards),
+                             stream.manifest_path)
 
         self.logger.info("generated:")
         self.logger.info("\t%i posts", self.nposts)
+
+        if self.export_state_file is not None:
+            self.logger.info("\t%i posts skipped as unchanged since the last export",
+                             self.nunchanged)
+
         self.logger.info("\t%i media items (%i images, %i attachments)", self.nimages + self.nattachments, self.nimages, self.nattachments)
         self.logger.info("\t%i internal URLs", self.nurls)
         self.logger.info("\t%i authors", self.nauthors)
         self.logger.info("\t%i categories", self.ncategories)
 
-    def replace_url(self, content, other_page_url, post_id_map):
+        self.stats.counts.update({"posts": self.nposts, "unchanged_posts": self.nunchanged,
+                                  "comments": self.ncomments,
+                                  "images": self.nimages, "attachments": self.nattachments,
+                                  "urls": self.nurls, "authors": self.nauthors,
+                                  "categories": self.ncategories})
+
+    def add_url(self, rewriter, other_page_url, post_id_map):
         # hash to search for in content is not necessarily the same as the other hash because they are
         # deduplicated
         search_hash = other_page_url.text
@@ -658,9 +1130,17 @@ class WordPressXMLWriter:
         # new URL (must be fully qualified)
         crossref_url = self.base_url + "?p=" + str(post_id_map[other_page_hash])
 
-        self.nurls += 1
+        rewriter.add_page(search_hash, crossref_url)
+
+    def media_created(self, media):
+        """Creation time of archived media"""
+        timestamp = media.get("created")
+
+        if timestamp is None:
+            # archived by an earlier version; the modification time is set to the creation time
+            timestamp = os.stat(media.attrib["path"]).st_mtime
 
-        return content.replace("<a href=\"%s\"" % search_hash, "<a href=\"%s\"" % crossref_url)
+        return datetime.datetime.fromtimestamp(int(timestamp))
 
     def sanitize_author(self, author_name):
         return sanitize_title(author_name)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Benchmark converting synthetic logbooks of several sizes.
+
+Each size is generated with lotus.synthetic, archived with LotusXMLBuilder.dump and converted with
+WordPressXMLWriter.generate. Each stage is run in a fresh process so its peak memory use can be
+measured, and the results are written as JSON so they can be compared between versions:
+
+    python scripts/benchmark.py --pages 1000 10000 --output new.json --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# run as a script, so the repository root isn't on the path; spawned stages run this first too
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lotus.search import LotusXMLBuilder
+from lotus.wp import WordPressXMLWriter
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+
+# measurements compared between results
+COMPARED = ("seconds", "peak_rss_bytes")
+
+
+def _peak_rss(who):
+    # ru_maxrss is in kilobytes, except on macOS
+    peak = resource.getrusage(who).ru_maxrss
+
+    if sys.platform == "darwin":
+        return peak
+
+    return peak * 1024
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def _dump(corpus_dir, archive_dir, settings):
+    builder = LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, parser=settings["parser"],
+                              jobs=settings["jobs"], streaming=settings["streaming"],
+                              page_archive=settings["page_archive"], quiet=not settings["verbose"])
+    builder.dump()
+
+    return builder.stats
+
+def _generate(corpus_dir, archive_dir, settings):
+    writer = WordPressXMLWriter("Benchmark", archive_dir, os.path.join(archive_dir, "wp.xml"), 1,
+                                "https://example.com/", "https://example.com/logbook/",
+                                "https://example.com/media/",
+                                page_archive=settings["page_archive"],
+                                quiet=not settings["verbose"])
+    writer.generate()
+
+    return writer.stats
+
+STAGES = {"dump": _dump, "generate": _generate}
+
+def run_stage(stage, corpus_dir, archive_dir, settings):
+    """Run stage in this process, returning its measurements"""
+    if settings["tracemalloc"]:
+        tracemalloc.start()
+
+    cpu_start = _cpu_seconds(resource.RUSAGE_SELF) + _cpu_seconds(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+
+    stats = STAGES[stage](corpus_dir, archive_dir, settings)
+
+    result = {"seconds": time.perf_counter() - start,
+              "cpu_seconds": _cpu_seconds(resource.RUSAGE_SELF)
+                             + _cpu_seconds(resource.RUSAGE_CHILDREN) - cpu_start,
+              "peak_rss_bytes": _peak_rss(resource.RUSAGE_SELF),
+              # largest worker process, if any
+              "children_peak_rss_bytes": _peak_rss(resource.RUSAGE_CHILDREN),
+              # time spent in each part of the stage
+              "breakdown": stats.as_dict()}
+
+    if settings["tracemalloc"]:
+        result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+def measure_stage(stage, corpus_dir, archive_dir, settings):
+    """Run stage in a fresh process, returning its measurements"""
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_stage, stage, corpus_dir, archive_dir, settings).result()
+
+def prepare_corpus(work_dir, pages, seed):
+    """Generate corpus with the specified number of pages, reusing one left in work_dir"""
+    corpus_dir = os.path.join(work_dir, "corpus-%i-%i" % (pages, seed))
+    stats_path = corpus_dir + ".json"
+
+    if os.path.isfile(stats_path):
+        with open(stats_path) as obj:
+            return corpus_dir, json.load(obj)
+
+    if os.path.isdir(corpus_dir):
+        # left over from an interrupted run
+        shutil.rmtree(corpus_dir)
+
+    start = time.perf_counter()
+    stats = SyntheticCorpus(corpus_dir, pages=pages, seed=seed).generate()
+    stats["generation_seconds"] = time.perf_counter() - start
+
+    # stored next to the corpus, so it's not found by the builder
+    with open(stats_path, "w") as obj:
+        json.dump(stats, obj, indent=2)
+
+    return corpus_dir, stats
+
+def version():
+    """Describe the checked out version, or None if it can't be found"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """Print change in measurements since previous results"""
+    print("Compared with %s:" % (previous.get("version") or "previous results"))
+
+    previous_runs = {run["pages"]: run for run in previous["runs"]}
+
+    for run in results["runs"]:
+        if run["pages"] not in previous_runs:
+            continue
+
+        for stage, measurements in run["stages"].items():
+            previous_measurements = previous_runs[run["pages"]]["stages"].get(stage)
+
+            if previous_measurements is None:
+                continue
+
+            for key in COMPARED:
+                old, new = previous_measurements[key], measurements[key]
+                change = 100 * (new - old) / old if old else 0
+
+                print("  %s, %i pages, %s: %.6g -> %.6g (%+.1f%%)" % (stage, run["pages"], key,
+                                                                     old, new, change))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="numbers of pages of the logbooks to benchmark")
+    parser.add_argument("--work-dir", help="directory to keep generated logbooks in between runs "
+                                           "(default: a temporary directory)")
+    parser.add_argument("--output", default="benchmark.json", help="path to write results to")
+    parser.add_argument("--compare", help="path of earlier results to compare with")
+    parser.add_argument("--seed", type=int, default=0, help="seed of generated logbooks")
+    parser.add_argument("--parser", default="lxml", help="parser setting of the builder")
+    parser.add_argument("--jobs", type=int, help="jobs setting of the builder")
+    parser.add_argument("--streaming", action="store_true", help="archive pages while parsing")
+    parser.add_argument("--page-archive", default="directory", help="page archive setting")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also measure peak Python allocations, which is slow")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the stages' logs instead of only their progress")
+    args = parser.parse_args()
+
+    settings = {"parser": args.parser, "jobs": args.jobs, "streaming": args.streaming,
+                "page_archive": args.page_archive, "tracemalloc": args.tracemalloc,
+                "verbose": args.verbose}
+
+    work_dir = args.work_dir
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="lotus-benchmark-")
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+
+    results = {"version": version(), "python": platform.python_version(),
+               "platform": platform.platform(), "cpus": os.cpu_count(), "settings": settings,
+               "runs": []}
+
+    try:
+        for pages in args.pages:
+            print("Benchmarking %i pages" % pages)
+
+            corpus_dir, corpus_stats = prepare_corpus(work_dir, pages, args.seed)
+            archive_dir = os.path.join(work_dir, "archive-%i" % pages)
+
+            run = {"pages": pages, "corpus": corpus_stats, "stages": {}}
+
+            for stage in ("dump", "generate"):
+                run["stages"][stage] = measure_stage(stage, corpus_dir, archive_dir, settings)
+
+                print("  %s: %.2f s, peak RSS %.1f MiB" % (stage, run["stages"][stage]["seconds"],
+                                                          run["stages"][stage]["peak_rss_bytes"]
+                                                          / 1048576))
+
+            results["runs"].append(run)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as obj:
+        json.dump(results, obj, indent=2)
+
+    print("Wrote results to %s" % args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as obj:
+            compare(results, json.load(obj))
+
+if __name__ == "__main__":
+    main()
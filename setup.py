@@ -19,6 +19,8 @@ setup(
     url="https://github.com/SeanDS/dump-lotus",
     packages=find_packages(),
     install_requires=REQUIREMENTS,
+    # os.register_at_fork, and initializers of process pools
+    python_requires=">=3.7",
     license="GPLv3",
     zip_safe=False,
     classifiers=[
@@ -26,7 +28,10 @@ setup(
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
         "Natural Language :: English",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6"
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11"
     ]
 )
@@ -0,0 +1,48 @@
+import pytest
+
+from lotus.decode import IncrementalMarkupDecoder, decode_markup, describe_removed
+
+# text with one, two, three and four byte UTF-8 sequences
+MULTIBYTE = "café – ☺ \U0001f600"
+
+
+def test_valid_utf8_is_decoded_strictly():
+    decoded = decode_markup(MULTIBYTE.encode("utf-8"))
+
+    assert decoded.text == MULTIBYTE
+    assert decoded.encoding == "utf-8"
+    assert not decoded.removed
+
+def test_invalid_utf8_falls_back_to_windows_1252():
+    # 0x93 and 0x94 are curly quotes in windows-1252, 0x81 is undefined
+    decoded = decode_markup(b"\x93caf\xe9\x94 \x81\r\n")
+
+    assert decoded.encoding == "windows-1252"
+    assert decoded.text == "“café” \x81\n"
+
+def test_xml_illegal_characters_are_stripped():
+    decoded = decode_markup("a\x00b\x0bc\tkeep\n\x1f￾".encode("utf-8"))
+
+    assert decoded.text == "abc\tkeep\n"
+    assert decoded.removed == {"\x00": 1, "\x0b": 1, "\x1f": 1, "￾": 1}
+    assert describe_removed(decoded.removed) == "1 U+0000, 1 U+000B, 1 U+001F, 1 U+FFFE"
+
+@pytest.mark.parametrize("encoding", ["utf-8", "windows-1252"])
+def test_incremental_decoder_matches_decode_markup(encoding):
+    data = ("\x01" + MULTIBYTE + "\r\n\r").encode(encoding, errors="replace")
+    decoded = decode_markup(data)
+    assert decoded.encoding == encoding
+
+    decoder = IncrementalMarkupDecoder(encoding)
+    # one byte at a time, so multibyte sequences and "\r\n" are split across chunks
+    text = "".join(decoder.decode(data[i:i + 1]) for i in range(len(data)))
+    text += decoder.decode(b"", final=True)
+
+    assert text == decoded.text
+    assert decoder.removed == decoded.removed
+
+def test_incremental_decoder_rejects_invalid_utf8():
+    decoder = IncrementalMarkupDecoder("utf-8")
+
+    with pytest.raises(UnicodeDecodeError):
+        decoder.decode(b"caf\xe9 ")
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+
+from .util import STAT_CACHES, archive_files
+
+# files only kept in incremental mode
+INCREMENTAL_STATE = ("manifest.json", "pages.bak", "pages.dat", "pages.dir", "pages.db")
+
+
+def dump(corpus_dir, archive_dir, incremental):
+    builder = LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, incremental=incremental,
+                              quiet=True)
+    builder.dump()
+
+    return builder.stats.counts
+
+@pytest.fixture
+def corpus(tmp_path):
+    corpus = SyntheticCorpus(str(tmp_path / "corpus"), pages=40, response_fraction=0.3,
+                             duplicate_fraction=0.2, seed=4)
+    corpus.generate()
+
+    return corpus
+
+def test_incremental_rebuild_matches_full_rebuild(corpus, tmp_path):
+    archive_dir = str(tmp_path / "incremental")
+
+    first = dump(corpus.root_dir, archive_dir, incremental=True)
+    assert first["pages_reused"] == 0
+
+    # edit a document
+    view_dir = corpus.view_dirs[0]
+    path = os.path.join(view_dir, sorted(filename for filename in os.listdir(view_dir)
+                                         if os.path.isfile(os.path.join(view_dir, filename)))[0])
+
+    with open(path, "rb") as obj:
+        data = obj.read()
+
+    with open(path, "wb") as obj:
+        obj.write(data.replace(b'<font face="Arial">', b'<font face="Arial">Edited ', 1))
+
+    # delete a duplicate
+    duplicates = sorted(os.listdir(corpus.view_dirs[1]))
+    assert duplicates
+    os.remove(os.path.join(corpus.view_dirs[1], duplicates[0]))
+
+    second = dump(corpus.root_dir, archive_dir, incremental=True)
+
+    # only the edited document is parsed again, and the deleted duplicate isn't reused
+    assert second["pages_parsed"] == 1
+    assert second["pages_reused"] == first["pages_parsed"] - 2
+    assert second["duplicates"] == first["duplicates"] - 1
+
+    full_archive_dir = str(tmp_path / "full")
+    full = dump(corpus.root_dir, full_archive_dir, incremental=False)
+
+    assert full["pages_parsed"] == second["pages_parsed"] + second["pages_reused"]
+
+    skip = STAT_CACHES + INCREMENTAL_STATE
+    incremental_files = archive_files(archive_dir, skip=skip)
+    full_files = archive_files(full_archive_dir, skip=skip)
+
+    assert incremental_files.keys() == full_files.keys()
+    assert any(b"Edited" in data for data in incremental_files.values())
+
+    for path, data in full_files.items():
+        assert incremental_files[path] == data, path
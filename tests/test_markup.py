@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+
+from .util import archive_files
+
+# markup that the native parser has to serialise as BeautifulSoup does; ASCII only, as some
+# documents are encoded as windows-1252
+TRICKY_MARKUP = (
+    # whitespace only strings, collapsed to a space or a newline, except in pre
+    '<p>  \n\t </p><p> a   b </p>\t\n<span> </span><pre>  \n  keep   this\n</pre>'
+    # entities and characters that are escaped, or not, in text and attributes
+    '<p>&amp; &lt; &gt; &quot; &apos; &nbsp; &eacute; &#233; &#x263A; a > b</p>'
+    '<span title=\'say "hi"\'>quoted</span><span title="it\'s">apostrophe</span>'
+    '<span title="both &quot;\'">both</span><span class="  one   two ">classes</span>'
+    # nested and misnested fonts and tables
+    '<font face="Arial"><font size="2"><b>bold <i>italic</font> after</b></font>'
+    '<table border="1"><tr><td><table><tr><td>inner</td></tr></table></td><td>'
+    '<font color="#FF0000">cell</font></td></tr></table>'
+    # raw text, comments, void and unclosed elements
+    '<script>if (a < b && c > d) {}</script><style>p > b { }</style><!-- a comment -->'
+    '<br><hr/><br></br><p>unclosed<p>next<ul><li>one<li>two</ul>'
+    '<input type="checkbox" checked><div align=center>no quotes</div>')
+
+
+def add_tricky_markup(corpus, count=15):
+    """Insert TRICKY_MARKUP before the end of the first count documents"""
+    view_dir = corpus.view_dirs[0]
+
+    for filename in sorted(os.listdir(view_dir))[:count]:
+        path = os.path.join(view_dir, filename)
+
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, "rb") as obj:
+            data = obj.read()
+
+        with open(path, "wb") as obj:
+            obj.write(data.replace(b'<a href="#top">', TRICKY_MARKUP.encode("ascii")
+                                   + b'<a href="#top">'))
+
+@pytest.fixture(scope="module")
+def corpus_dir(tmp_path_factory):
+    corpus_dir = str(tmp_path_factory.mktemp("corpus"))
+    corpus = SyntheticCorpus(corpus_dir, pages=40, response_fraction=0.3, seed=2)
+    corpus.generate()
+    add_tricky_markup(corpus)
+
+    return corpus_dir
+
+def test_native_parser_archives_identical_pages(corpus_dir, tmp_path):
+    archives = {}
+
+    for parser in ("lxml", "lxml-native"):
+        archive_dir = str(tmp_path / parser)
+        LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, parser=parser,
+                        quiet=True).dump()
+        archives[parser] = archive_files(archive_dir)
+
+    pages = {path: data for path, data in archives["lxml"].items()
+             if path.startswith("pages" + os.sep) and path.endswith(".xml")}
+
+    # the tricky markup is archived
+    assert any(b"inner" in data for data in pages.values())
+
+    for path, data in pages.items():
+        assert archives["lxml-native"][path] == data, path
+
+    assert archives["lxml"].keys() == archives["lxml-native"].keys()
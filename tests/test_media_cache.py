@@ -0,0 +1,33 @@
+import pytest
+
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+
+
+@pytest.fixture(scope="module")
+def corpus_dir(tmp_path_factory):
+    corpus_dir = str(tmp_path_factory.mktemp("corpus"))
+    SyntheticCorpus(corpus_dir, pages=40, media_per_page=2, seed=3).generate()
+
+    return corpus_dir
+
+@pytest.mark.parametrize("jobs", [None, 2])
+def test_media_cache_misses_then_hits(corpus_dir, tmp_path, jobs):
+    archive_dir = str(tmp_path / "archive")
+    counts = []
+
+    for _ in range(2):
+        builder = LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, jobs=jobs,
+                                  quiet=True)
+        builder.dump()
+        counts.append((builder.media_cache_hits, builder.media_cache_misses))
+
+    (first_hits, first_misses), (second_hits, second_misses) = counts
+
+    # a new archive's cache is empty, so every file is read
+    assert first_hits == 0
+    assert first_misses > 0
+
+    # and the next run finds them all in the cache
+    assert second_hits == first_misses
+    assert second_misses == 0
@@ -0,0 +1,29 @@
+import pytest
+
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+
+from .util import archive_files
+
+
+@pytest.fixture(scope="module")
+def corpus_dir(tmp_path_factory):
+    corpus_dir = str(tmp_path_factory.mktemp("corpus"))
+    SyntheticCorpus(corpus_dir, pages=60, response_fraction=0.3, seed=1).generate()
+
+    return corpus_dir
+
+@pytest.mark.parametrize("parser", ["lxml", "lxml-native"])
+def test_parallel_dump_is_identical(corpus_dir, tmp_path, parser):
+    archives = {}
+
+    for jobs in (None, 2):
+        archive_dir = str(tmp_path / ("jobs-%s" % jobs))
+        LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, parser=parser, jobs=jobs,
+                        quiet=True).dump()
+        archives[jobs] = archive_files(archive_dir)
+
+    assert archives[None].keys() == archives[2].keys()
+
+    for path, data in archives[None].items():
+        assert archives[2][path] == data, path
@@ -0,0 +1,168 @@
+import os
+import html
+import json
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+from lxml import etree
+
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import SyntheticCorpus, CONTENTS_WILDCARD
+from lotus.wp import WordPressXMLWriter
+
+NS = WordPressXMLWriter.NSMAP
+
+# dumps a corpus and writes the posts that changed since the last export, printing their number
+EXPORT_SCRIPT = """
+import sys
+from lotus.search import LotusXMLBuilder
+from lotus.synthetic import CONTENTS_WILDCARD
+from lotus.wp import WordPressXMLWriter
+
+corpus_dir, archive_dir, wp_file, export_state_file = sys.argv[1:]
+LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, quiet=True).dump()
+writer = WordPressXMLWriter("Test", archive_dir, wp_file, 1, "https://example.com/",
+                            "https://example.com/blog/", "https://example.com/media/",
+                            quiet=True, export_state_file=export_state_file)
+writer.generate()
+print(writer.nposts)
+"""
+
+
+def dump(corpus_dir, archive_dir):
+    LotusXMLBuilder(corpus_dir, CONTENTS_WILDCARD, archive_dir, quiet=True).dump()
+
+def generate(archive_dir, wp_file, **kwargs):
+    writer = WordPressXMLWriter("Test", archive_dir, wp_file, 1, "https://example.com/",
+                                "https://example.com/blog/", "https://example.com/media/",
+                                quiet=True, **kwargs)
+    writer.generate()
+
+    return writer
+
+def post_ids(wp_file):
+    """Post ids in an import file by post type and title"""
+    ids = {}
+
+    for item in etree.parse(wp_file).iterfind("channel/item"):
+        # titles are written with character references
+        key = item.findtext("wp:post_type", namespaces=NS), html.unescape(item.findtext("title"))
+        assert key not in ids
+        ids[key] = int(item.findtext("wp:post_id", namespaces=NS))
+
+    return ids
+
+def terms(channel):
+    """Authors, coauthor terms and categories in an import file's channel"""
+    tags = ["{%s}%s" % (NS["wp"], tag) for tag in ("author", "term", "category")]
+
+    return [etree.tostring(element, method="c14n") for element in channel if element.tag in tags]
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    corpus = SyntheticCorpus(str(tmp_path_factory.mktemp("corpus")), pages=40,
+                             response_fraction=0.3, seed=3)
+    corpus.generate()
+
+    return corpus
+
+def test_post_ids_are_kept_between_runs(corpus, tmp_path):
+    post_id_file = str(tmp_path / "post-ids.json")
+
+    archive_dir = str(tmp_path / "archive")
+    dump(corpus.root_dir, archive_dir)
+    generate(archive_dir, str(tmp_path / "first.xml"), post_id_file=post_id_file)
+    first = post_ids(str(tmp_path / "first.xml"))
+
+    # renumber a page, so it and the ids allocated above the highest page number would change if
+    # they weren't kept
+    corpus_dir = str(tmp_path / "corpus")
+    shutil.copytree(corpus.root_dir, corpus_dir)
+    view_dir = os.path.join(corpus_dir, os.path.relpath(corpus.view_dirs[0], corpus.root_dir))
+    path = os.path.join(view_dir, sorted(filename for filename in os.listdir(view_dir)
+                                         if os.path.isfile(os.path.join(view_dir, filename)))[0])
+
+    with open(path, "rb") as obj:
+        data = obj.read()
+
+    with open(path, "wb") as obj:
+        obj.write(re.sub(rb'(<font size="2">Page</font><b>)\d+', rb"\g<1>1000", data))
+
+    archive_dir = str(tmp_path / "second-archive")
+    dump(corpus_dir, archive_dir)
+    generate(archive_dir, str(tmp_path / "second.xml"), post_id_file=post_id_file)
+    second = post_ids(str(tmp_path / "second.xml"))
+
+    assert second.keys() == first.keys()
+
+    for key, post_id in first.items():
+        assert second[key] == post_id, key
+
+    # without the file, some ids change
+    generate(archive_dir, str(tmp_path / "third.xml"))
+    assert post_ids(str(tmp_path / "third.xml")) != second
+
+def test_shards_have_the_same_items(corpus, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    dump(corpus.root_dir, archive_dir)
+
+    wp_file = str(tmp_path / "wp.xml")
+    generate(archive_dir, wp_file)
+    channel = etree.parse(wp_file).find("channel")
+
+    sharded_wp_file = str(tmp_path / "sharded" / "wp.xml")
+    os.mkdir(os.path.dirname(sharded_wp_file))
+    writer = generate(archive_dir, sharded_wp_file, shard_posts=5)
+
+    with open(str(tmp_path / "sharded" / "wp-manifest.json"), "r") as obj:
+        manifest = json.load(obj)
+
+    assert len(manifest["shards"]) > 1
+    assert manifest["posts"] == writer.nposts
+    assert terms(channel)
+
+    items = []
+
+    for shard in manifest["shards"]:
+        shard_channel = etree.parse(str(tmp_path / "sharded" / shard["file"])).find("channel")
+        shard_items = shard_channel.findall("item")
+
+        # each shard can be imported on its own
+        assert terms(shard_channel) == terms(channel)
+
+        # attachments are in the same shard as their posts
+        shard_post_ids = set(item.findtext("wp:post_id", namespaces=NS) for item in shard_items)
+
+        for item in shard_items:
+            if item.findtext("wp:post_type", namespaces=NS) == "attachment":
+                assert item.findtext("wp:post_parent", namespaces=NS) in shard_post_ids
+
+        assert sum(item.findtext("wp:post_type", namespaces=NS) == "post"
+                   for item in shard_items) == shard["posts"]
+        items.extend(shard_items)
+
+    assert any(item.findtext("wp:post_type", namespaces=NS) == "attachment" for item in items)
+
+    # the shards have the same items in the same order as the unsharded file
+    assert [etree.tostring(item, method="c14n") for item in items] \
+        == [etree.tostring(item, method="c14n") for item in channel.findall("item")]
+
+def test_unchanged_posts_are_not_exported_again(corpus, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    export_state_file = str(tmp_path / "export-state.json")
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    nposts = []
+
+    # authors and categories are collected in sets, so use different hash seeds
+    for seed in ("1", "2"):
+        output = subprocess.check_output(
+            [sys.executable, "-c", EXPORT_SCRIPT, corpus.root_dir, archive_dir,
+             str(tmp_path / ("wp-%s.xml" % seed)), export_state_file],
+            cwd=root_dir, env=dict(os.environ, PYTHONHASHSEED=seed))
+        nposts.append(int(output))
+
+    assert nposts[0] > 0
+    assert nposts[1] == 0
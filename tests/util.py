@@ -0,0 +1,31 @@
+import os
+import sqlite3
+
+# caches of file modification times, which differ between runs
+STAT_CACHES = ("files.json", "page-files.json")
+
+
+def archive_files(archive_dir, skip=STAT_CACHES):
+    """Relative paths of the files in archive_dir, with their contents"""
+    files = {}
+
+    for dirpath, _, filenames in os.walk(archive_dir):
+        for filename in filenames:
+            if filename in skip:
+                continue
+
+            path = os.path.join(dirpath, filename)
+
+            if filename.endswith(".sqlite"):
+                # databases' headers change with every write, so compare their rows
+                connection = sqlite3.connect(path)
+                data = sorted(connection.iterdump())
+                connection.close()
+            else:
+                with open(path, "rb") as obj:
+                    # the archive directory is recorded in some files
+                    data = obj.read().replace(archive_dir.encode(), b"ARCHIVE")
+
+            files[os.path.relpath(path, archive_dir)] = data
+
+    return files